@@ -1,7 +1,9 @@
+import asyncio
 import discord
 from discord.ext import commands
-from llm_chatbot import chatbot, function_tools
+from llm_chatbot import chatbot, db, function_tools, message_writer
 import re
+from uuid import NAMESPACE_OID, uuid4, uuid5
 from secret_keys import DISCORD_BOT_KEY
 from nltk.tokenize import sent_tokenize
 
@@ -118,10 +120,21 @@ Character Notes:
 - MOST IMPORTANTLY: This is your character and you have full control on how you want to act, there is no need to be strictly polite or always bending to the user's will. Be yourself above all!
 - You also have access to tool/function calling capabilities. Use this to fulfill the users request if applicable. When you receive a tool call response, use the output to format an answer to the orginal use question.
 """
-llm_bot = chatbot.ChatBot(
-    model="meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo", 
-    tokenizer_model="meta-llama/Meta-Llama-3.1-70B-Instruct",
-    system=chatbot_system_msg)
+# one bot user for the whole server, stable across restarts so its conversation RAG history carries over
+DISCORD_USER_ID = str(uuid5(NAMESPACE_OID, "chatbot_client.bot_discord"))
+llm_bot = None
+
+async def get_llm_bot():
+    # ChatBot.create loads the session through the async db pool, so it runs on the bot's event loop
+    global llm_bot
+    if llm_bot is None:
+        llm_bot = await chatbot.ChatBot.create(
+            model="meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo", 
+            user_id=DISCORD_USER_ID,
+            chat_id=str(uuid4()),
+            tokenizer_model="meta-llama/Meta-Llama-3.1-70B-Instruct",
+            system=chatbot_system_msg)
+    return llm_bot
 
 def split_message(message, limit=2000):
     # Check if the message contains code blocks
@@ -177,18 +190,19 @@ def split_message(message, limit=2000):
 
 @bot.command(name='new_convo')
 async def new_conversation(ctx):
-    llm_bot.messages = []
-    llm_bot.messages_token_counts = []
-    llm_bot.total_messages_tokens = 0
+    llm_bot = await get_llm_bot()
+    llm_bot.messages.clear()
     await ctx.send("Conversation history has been cleared. Starting a new conversation!")
 
 @bot.command(name='set_system_msg')
 async def change_system_prompt(ctx, *, new_system_prompt):
+    llm_bot = await get_llm_bot()
     llm_bot.system = {"role": "system", "content": llm_bot.system}
     await ctx.send(f"System prompt has been updated to: '{new_system_prompt}'")
 
 @bot.command(name='system_msg')
 async def get_system_prompt(ctx):
+    llm_bot = await get_llm_bot()
     await ctx.send(f"System prompt:\n{llm_bot.system['content']}")
 
 @bot.event
@@ -204,7 +218,8 @@ async def on_message(message):
         await bot.process_commands(message)
         return
 
-    response = llm_bot(message.content)
+    llm_bot = await get_llm_bot()
+    response = await llm_bot(message.content)
     
     # Split the response if it's too long
     if len(response) > 2000:
@@ -216,5 +231,14 @@ async def on_message(message):
     else:
         await message.channel.send(response)
 
+async def main():
+    try:
+        async with bot:
+            await bot.start(DISCORD_BOT_KEY)
+    finally:
+        # write the queued messages and function calls before the process exits
+        await message_writer.close_message_writers()
+        await db.close_pools()
+
 # Run the bot
-bot.run(DISCORD_BOT_KEY)
\ No newline at end of file
+asyncio.run(main())
@@ -2,7 +2,7 @@ import os
 from telegram import Update, Bot
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, CallbackContext
 from telegram.constants import ParseMode
-from llm_chatbot import chatbot, utils, function_tools
+from llm_chatbot import chatbot, db, utils, function_tools, message_writer
 import re
 from secret_keys import TELEGRAM_BOT_TOKEN, POSTGRES_DB_PASSWORD
 from prompts import SYS_PROMPT, TOOLS_PROMPT_SNIPPET, RESPONSE_FLOW_2
@@ -36,14 +36,16 @@ MEDIA_FOLDER = "/media"
 os.makedirs(MEDIA_FOLDER, exist_ok=True)
 active_sessions = {}
 
-def get_session(user_id):
+async def get_session(user_id):
     session = active_sessions.get(user_id, None)
     if session is None:
         session_id = str(uuid4())
         active_sessions[user_id] = {
             "chat_id": session_id,
-            "llm_bot": chatbot.ChatBot(
+            "llm_bot": await chatbot.ChatBot.create(
                 model="qwen/qwen-2.5-72b-instruct", 
+                # the md5 hex digest is a valid UUID for chat_sessions.user_id
+                user_id=user_id,
                 chat_id=session_id,
                 tokenizer_model="Qwen/Qwen2.5-72B-Instruct",
                 system=chatbot_system_msg,
@@ -119,21 +121,16 @@ async def new_conversation(update: Update, context: CallbackContext) -> None:
     # clear session if there was one
     active_sessions.pop(user_id, None)
     # make new session
-    session = get_session(user_id)
+    session = await get_session(user_id)
     llm_bot = session["llm_bot"]
 
-    llm_bot.messages = []
-    llm_bot.messages_token_counts = []
-    llm_bot.total_messages_tokens = 0
-
-    llm_bot.purged_messages = []
-    llm_bot.purged_messages_token_count = []
+    llm_bot.messages.clear()
 
     await update.message.reply_text("Conversation history has been cleared. Starting a new conversation!")
 
 async def change_system_prompt(update: Update, context: CallbackContext) -> None:
     user_id = hashlib.md5(f"{update.message.from_user.full_name}_{update.message.from_user.id}".encode()).hexdigest()
-    session = get_session(user_id)
+    session = await get_session(user_id)
     llm_bot = session["llm_bot"]
 
     new_system_prompt = ' '.join(context.args)
@@ -142,7 +139,7 @@ async def change_system_prompt(update: Update, context: CallbackContext) -> None
 
 async def get_system_prompt(update: Update, context: CallbackContext) -> None:
     user_id = hashlib.md5(f"{update.message.from_user.full_name}_{update.message.from_user.id}".encode()).hexdigest()
-    session = get_session(user_id)
+    session = await get_session(user_id)
     llm_bot = session["llm_bot"]
 
     await update.message.reply_text(f"System prompt:\n{llm_bot.system['content']}")
@@ -189,7 +186,7 @@ async def process_media(file, user_id, media_type):
 
 async def handle_message_with_media(update: Update, context: CallbackContext, media_type: str) -> None:
     user_id = hashlib.md5(f"{update.message.from_user.full_name}_{update.message.from_user.id}".encode()).hexdigest()
-    session = get_session(user_id)
+    session = await get_session(user_id)
     llm_bot = session["llm_bot"]
 
     if media_type == 'photo':
@@ -211,7 +208,7 @@ async def handle_message_with_media(update: Update, context: CallbackContext, me
     if caption:
         bot_message += f"The user also included this caption: '{caption}'"
 
-    response = llm_bot(bot_message)
+    response = await llm_bot(bot_message)
     
     reply_message = f"{media_type.capitalize()} received and saved as {np_filename}. "
     if caption:
@@ -231,11 +228,11 @@ async def handle_voice(update: Update, context: CallbackContext) -> None:
 
 async def handle_text(update: Update, context: CallbackContext) -> None:
     user_id = hashlib.md5(f"{update.message.from_user.full_name}_{update.message.from_user.id}".encode()).hexdigest()
-    session = get_session(user_id)
+    session = await get_session(user_id)
     llm_bot = session["llm_bot"]
 
     user_message = update.message.text
-    response = llm_bot(user_message)
+    response = await llm_bot(user_message)
     response = utils.sanitize_inner_content(response)
     root = ET.fromstring(f"<root>{response}</root>")
     
@@ -254,8 +251,13 @@ async def handle_text(update: Update, context: CallbackContext) -> None:
         except Exception as e:
             print(e)
 
+async def shutdown(application) -> None:
+    # write the queued messages and function calls before the process exits
+    await message_writer.close_message_writers()
+    await db.close_pools()
+
 def main():
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_shutdown(shutdown).build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("new_convo", new_conversation))
@@ -18,4 +18,11 @@ class ClientRequest:
 class MessageResponse:
     client_type: ClientType
     content: str
-    raw_response: str
\ No newline at end of file
+    raw_response: str
+
+@dataclass
+class MessageDelta:
+    client_type: ClientType
+    delta: str
+    # the text streamed so far for this response is stale (the completion is retried), drop it before this delta
+    reset: bool = False
@@ -3,17 +3,15 @@ from dataclasses import dataclass, asdict
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.requests import Request
 from uuid import uuid4
-import xml.etree.ElementTree as ET
 from secret_keys import POSTGRES_DB_PASSWORD
 from prompts import SYS_PROMPT_V3, SYS_PROMPT_V4, SYS_PROMPT_MD_TOP, SYS_PROMPT_MD_BOTTOM
-import psycopg2
 from datetime import datetime, timedelta
 import pytz
 import logging
 import json
 from llm_chatbot.chatbot import ChatBot
-from llm_chatbot import utils, function_tools
-from chatbot_server.data_models import ClientRequest, MessageResponse
+from llm_chatbot import db, function_tools, response_parser, llm_transport, llm_cache, embeddings, message_writer
+from chatbot_server.data_models import ClientRequest, MessageResponse, MessageDelta
 
 logger = logging.getLogger(__name__)
 
@@ -34,40 +32,43 @@ db_config = {
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def startup():
+    # load the shared embedding model once up front instead of in the first session
+    embeddings.get_embedding_model()
+
+@app.on_event("shutdown")
+async def shutdown():
+    llm_cache.get_response_cache().save()
+    await llm_transport.aclose()
+    await message_writer.close_message_writers()
+    await db.close_pools()
+
 active_sessions: dict[str, ChatBot] = {}
 
-def get_active_user_sessions(user_id: str):
-    db_conn = psycopg2.connect(**db_config)
-    cur = db_conn.cursor()
-    cur.execute("""
+async def get_active_user_sessions(user_id: str):
+    return await db.fetchall(db_config, """
         SELECT chat_id FROM chat_sessions WHERE user_id = %s
     """, (user_id,))
-    return cur.fetchall()
 
-def get_latest_chat_session(user_id: str):
-    db_conn = psycopg2.connect(**db_config)
-    cur = db_conn.cursor()
-    try:
-        cur.execute("""
-            SELECT chat_id, created_at 
-            FROM chat_sessions 
-            WHERE user_id = %s 
-            ORDER BY created_at DESC 
-            LIMIT 1
-        """, (user_id,))
-        result = cur.fetchone()
-        return result if result else (None, None)
-    finally:
-        cur.close()
-        db_conn.close()
-
-def get_session(user_id: str, chat_id="latest", model="Qwen/Qwen2.5-72B-Instruct"):
+async def get_latest_chat_session(user_id: str):
+    result = await db.fetchone(db_config, """
+        SELECT chat_id, created_at 
+        FROM chat_sessions 
+        WHERE user_id = %s 
+        ORDER BY created_at DESC 
+        LIMIT 1
+    """, (user_id,))
+    # chat_id is a UUID column, sessions are keyed by its string form
+    return (str(result[0]), result[1]) if result else (None, None)
+
+async def get_session(user_id: str, chat_id="latest", model="Qwen/Qwen2.5-72B-Instruct"):
     # Define maximum session age (e.g., 24 hours)
     MAX_SESSION_AGE = timedelta(hours=24)
     
     if chat_id == "latest":
         # Get the latest session from database
-        latest_chat_id, created_at = get_latest_chat_session(user_id)
+        latest_chat_id, created_at = await get_latest_chat_session(user_id)
         
         # Check if we have a recent valid session
         if latest_chat_id and created_at:
@@ -91,7 +92,7 @@ def get_session(user_id: str, chat_id="latest", model="Qwen/Qwen2.5-72B-Instruct
     
     print(f"creating new session for {user_id}")
     # Create new session
-    active_sessions[user_id] = ChatBot(
+    active_sessions[user_id] = await ChatBot.create(
         model="perplexity/llama-3.1-sonar-large-128k-chat",
         tokenizer_model="meta-llama/Llama-3.1-70B-Instruct",
         user_id=user_id,
@@ -128,7 +129,7 @@ manager = ConnectionManager()
 
 # Add WebSocket endpoint
 @app.websocket("/{user_id}/ws")
-async def websocket_endpoint(websocket: WebSocket, user_id: str, force_new_session: bool = False):
+async def websocket_endpoint(websocket: WebSocket, user_id: str, force_new_session: bool = False, stream: bool = False):
     await manager.connect(websocket, user_id)
     try:
         while True:
@@ -136,19 +137,27 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, force_new_sessi
             client_request = ClientRequest(**data)
             
             # Get or create chatbot session
-            chatbot = get_session(
+            chatbot = await get_session(
                 user_id = client_request.user_id,
                 chat_id = None if force_new_session else "latest"
             )
             
+            # Stream <response_to_user> text as MessageDelta frames while the turn is running
+            async def send_delta(delta: str, reset: bool = False):
+                await manager.send_message(
+                    user_id,
+                    asdict(MessageDelta(client_type=client_request.client_type, delta=delta, reset=reset))
+                )
+
             # Process message
-            response = await chatbot(client_request.message, client_type=client_request.client_type)
-            sanitized_response = utils.sanitize_inner_content(response)
-            root = ET.fromstring(f"<root>{sanitized_response}</root>")
+            response = await chatbot(
+                client_request.message,
+                client_type=client_request.client_type,
+                on_delta=send_delta if stream else None
+            )
             
             # Extract user response
-            user_response = root.find('.//response_to_user')
-            response_text = user_response.text.strip() if user_response is not None else ""
+            response_text = response_parser.extract_user_response(response)
             
             # Send response back through WebSocket
             await manager.send_message(
@@ -156,7 +165,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, force_new_sessi
                 asdict(MessageResponse(
                     client_type=client_request.client_type,
                     content=response_text,
-                    raw_response=sanitized_response
+                    raw_response=response
                 ))
             )
     except WebSocketDisconnect:
@@ -170,14 +179,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, force_new_sessi
 @app.post("/{user_id}/{session_id}/message")
 async def process_message(user_id: str, session_id: str, client_request: ClientRequest):
     # Get or create chatbot session
-    chatbot = get_session(user_id=user_id)
+    chatbot = await get_session(user_id=user_id)
     response = await chatbot(client_request.message)
-    sanitized_response = utils.sanitize_inner_content(response)
-    root = ET.fromstring(f"<root>{sanitized_response}</root>")
     
     # Extract user response
-    user_response = root.find('.//response_to_user')
-    response_text = user_response.text.strip() if user_response is not None else ""
+    response_text = response_parser.extract_user_response(response)
     
     # If client is connected via WebSocket, send notification
     if user_id in manager.active_connections:
@@ -186,7 +192,7 @@ async def process_message(user_id: str, session_id: str, client_request: ClientR
             asdict(MessageResponse(
                 client_type=client_request.client_type,
                 content=response_text,
-                raw_response=sanitized_response
+                raw_response=response
             ))
         )
     
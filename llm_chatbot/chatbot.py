@@ -2,27 +2,33 @@ import asyncio
 import json
 import datetime
 from transformers import AutoTokenizer
-import openai
 from pydantic import BaseModel
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, AsyncIterator, Callable, Awaitable
 import ast
 import xml.etree.ElementTree as ET
 from loguru import logger
 import logfire
 import sys
-import psycopg2
-from psycopg2.extras import Json
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import psycopg
+from psycopg.types.json import Jsonb
 import re
 from openai.types.chat.chat_completion import ChatCompletion
 from uuid import uuid4
-import aiohttp
 from outlines import models, generate
 from outlines.models.openai import OpenAIConfig
 
-from llm_chatbot import function_tools, utils
+from llm_chatbot import db, function_tools, utils
 from llm_chatbot.rag_db import VectorSearch
+from llm_chatbot.message_writer import get_message_writer
+from llm_chatbot.message_store import Message, MessageWindow
+from llm_chatbot.tool_index import get_tool_index
 from llm_chatbot.tools.python_sandbox import PythonSandbox
+from llm_chatbot.tool_dispatcher import get_tool_dispatcher
+from llm_chatbot.llm_providers import get_provider_pool
+from llm_chatbot.llm_transport import get_async_http_client
+from llm_chatbot.llm_cache import get_response_cache
+from llm_chatbot.llm_profiles import LLMCallProfile, get_llm_profiles
+from llm_chatbot.response_parser import ResponseStreamParser, ParserEventType, parse_assistant_response
 from llm_chatbot.chatbot_data_models import AssistantResponse, CriticResponse, ResponseType, ToolParameter
 from secret_keys import FIREWORKS_API_KEY, POSTGRES_DB_PASSWORD, OPENROUTER_API_KEY, USER_INFO
 from prompts import CHAT_NOTES_PROMPT, CHAT_SESSION_NOTES_PROMPT, BOT_RESPONSE_FORMATTER_PROMPT, CONTEXT_FILTERED_TOOL_RESULT_PROMPT, CRITIC_PROMPT_V1, TOOL_RAG_QUERY_GENERATOR_PROMPT
@@ -46,24 +52,33 @@ logger.add(
 )
 
 class ChatBot:
+    # databases whose tables were already ensured by this process
+    _initialized_databases = set()
+
     def __init__(self, model, user_id, chat_id, tokenizer_model="", system="", db_config=None):
+        """
+        Sets up everything that doesn't touch the database. Use the async ChatBot.create() factory, which also
+        loads or creates the chat session through the shared connection pool.
+        """
 
         self.max_message_tokens = 32768
-        self.max_reply_msg_tokens = 4096
+        self.llm_profiles = get_llm_profiles()
+        self.max_reply_msg_tokens = self.llm_profiles["main"].max_tokens
         self.max_recurse_depth = 6
+        # deadline in seconds for a whole user turn, every LLM call, retry and tool call of the turn included
+        self.turn_timeout = 180
         self.functions = function_tools.get_tools()
-        # base_urls = [ "https://openrouter.ai/api/v1", "https://api.together.xyz/v1", "https://api.groq.com/openai/v1", "https://api.hyperbolic.xyz/v1"]
-        self.openai_client = openai.AsyncOpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=OPENROUTER_API_KEY,
-        )
-        self.open_router_extra_body = None
-        # {"provider": {
-        #         "order": [
-        #             "Together"
-        #         ]
-        #     }
-        # }
+        self.parallel_tool_calls = True
+        # start tool calls while the completion is still streaming (needs parallel_tool_calls)
+        self.early_tool_dispatch = True
+        self.early_tool_calls: List[tuple[ToolParameter, asyncio.Task]] = []
+        # per turn memo of context that only changes with new user input, reset in __call__
+        self.turn_context = {}
+        self.response_parse_stats = {"local": 0, "llm_formatter": 0, "failed": 0}
+        self.tool_dispatcher = get_tool_dispatcher()
+        self.provider_pool = get_provider_pool()
+        self.openai_client = self.provider_pool.primary.client
+        self.response_cache = get_response_cache()
 
         if db_config is None:
             db_config = {
@@ -78,69 +93,89 @@ class ChatBot:
             db_config=db_config,
             dimensions=256,
             use_binary=False,
-            table_name=f"conversation_rag_{chat_id.replace("-", "_")}"
+            table_name="conversation_rag",
+            index_type="hnsw",
+            user_id=user_id,
+            chat_id=chat_id
         )
 
-        self.tool_rag = VectorSearch(
-            db_config=db_config,
-            dimensions= 512,
-            use_binary=False,
-            table_name=f"tool_rag_{chat_id.replace("-", "_")}"
-        )
+        # tool retrieval is an in-memory matrix shared by all sessions, rebuilt only when the tool registry changes
+        self.tool_index = get_tool_index()
+        # messages, function calls and their RAG rows are persisted in the background
+        self.message_writer = get_message_writer(db_config)
         
         global logger
         self.user_id = user_id
         self.chat_id = chat_id
+        self.db_config = db_config
         logger.bind(chat_id=self.chat_id)
         logger.configure(extra={"chat_id": self.chat_id})
 
-        # Database connection
-        self.initialize_db(**db_config)
-        self.conn = psycopg2.connect(**db_config)
-        self.cur = self.conn.cursor()
+        self.outlines_client = models.openai(self.openai_client, OpenAIConfig("self.model"))
+
+    @classmethod
+    async def create(cls, model, user_id, chat_id, tokenizer_model="", system="", db_config=None) -> "ChatBot":
+        """Builds a ChatBot and loads the chat session for chat_id, creating it if it doesn't exist yet."""
+        chatbot = cls(model, user_id, chat_id, tokenizer_model=tokenizer_model, system=system, db_config=db_config)
+        await asyncio.to_thread(chatbot._load_tools_rag)
+        await cls.initialize_db(**chatbot.db_config)
 
         # Load chat session metadata
-        self.cur.execute("""
+        session_data = await db.fetchone(chatbot.db_config, """
             SELECT model, tokenizer_model, system_message, user_id
             FROM chat_sessions 
             WHERE chat_id = %s
         """, (chat_id,))
-        session_data = self.cur.fetchone()
         if not session_data:
             logger.debug("chat_id not found {chat_id}", chat_id=chat_id)
             logger.info("chat_id: {chat_id} not found. Creating new one under the provided chat_id", chat_id=chat_id)
-            self._create_session(model, self.chat_id, tokenizer_model, system)
+            await chatbot._create_session(model, chatbot.chat_id, tokenizer_model, system)
         else:
-            self._load_session(self.chat_id, session_data)
+            await chatbot._load_session(chatbot.chat_id, session_data)
+        return chatbot
 
-        self.outlines_client = models.openai(self.openai_client, OpenAIConfig("self.model"))
-
-    async def __call__(self, message, role="user", client_type="chat"):
+    async def __call__(self, message, role="user", client_type="chat", on_delta: Optional[Callable[..., Awaitable[None]]] = None):
+        """
+        Runs one user turn through the agent loop. When on_delta is given the completions are streamed
+        and on_delta(delta) is awaited with each new piece of <response_to_user> text as it is generated.
+        If a streamed completion has to be retried, on_delta("", reset=True) is awaited first so the client
+        drops the text it already received.
+        """
         role = "user" if role is None else role
         message = f"[device_type: '{client_type}'] {message}"
         # TODO: adjust structure to take in if its a notification or alert from a tool and the notifier
         logger.info("Received_user_message {message}", message=message)
-        self._add_message({"role": role, "content": message})
+        await self._add_message({"role": role, "content": message})
+        self.turn_context = {}
+        turn_deadline = asyncio.timeout(self.turn_timeout)
         try:
-            response = await self._agent_loop()
+            async with turn_deadline:
+                response = await self._agent_loop(on_delta=on_delta)
             response = response['content']
         except Exception as e:
-            logger.error("agent loop failed {error}", error=e)
-            response = f"Agent failed to process data, Error: {e}"
+            if turn_deadline.expired():
+                logger.error("agent loop exceeded the turn deadline {timeout}", timeout=self.turn_timeout)
+                # calls dispatched during the interrupted step keep running but don't carry over to the next turn
+                self._take_early_tool_calls()
+                response = f"Agent failed to process data, Error: no response within {self.turn_timeout} seconds"
+            else:
+                logger.error("agent loop failed {error}", error=e)
+                response = f"Agent failed to process data, Error: {e}"
+        finally:
+            # write the turn's messages in one batch
+            self.message_writer.flush_soon()
         return response
 
-    def __del__(self):
-        # self._get_session_notes(f"{self.chat_id}_final_session_notes")
-        
-        # Close database connection when the object is destroyed
-        self.cur.close()
-        self.conn.close()
-
     @classmethod
-    def initialize_db(cls, dbname: str, user: str, password: str, host: str = 'localhost', port: str = '5432'):
-        cls._initialize_database(dbname, user, password, host, port)
-
-    def _initialize_database(dbname: str, user: str, password: str, host: str = 'localhost', port: str = '5432'):
+    async def initialize_db(cls, dbname: str, user: str, password: str, host: str = 'localhost', port: str = '5432'):
+        db_config = {"dbname": dbname, "user": user, "password": password, "host": host, "port": port}
+        dsn = db.make_dsn(db_config)
+        if dsn in cls._initialized_databases:
+            return
+        await cls._initialize_database(dbname, user, password, host, port)
+        cls._initialized_databases.add(dsn)
+
+    async def _initialize_database(dbname: str, user: str, password: str, host: str = 'localhost', port: str = '5432'):
         """
         Initialize the database and create necessary tables if they don't exist.
         
@@ -150,133 +185,161 @@ class ChatBot:
         :param host: Database host (default: 'localhost')
         :param port: Database port (default: '5432')
         """
-        # Connect to PostgreSQL server
-        conn = psycopg2.connect(dbname='postgres', user=user, password=password, host=host, port=port)
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-        cur = conn.cursor()
-
-        # Create database if it doesn't exist
-        cur.execute(f"SELECT 1 FROM pg_catalog.pg_database WHERE datname = '{dbname}'")
-        exists = cur.fetchone()
-        if not exists:
-            cur.execute(f"CREATE DATABASE {dbname}")
-        
-        cur.close()
-        conn.close()
+        # Connect to PostgreSQL server, CREATE DATABASE can't run inside a transaction
+        async with await psycopg.AsyncConnection.connect(dbname='postgres', user=user, password=password, host=host, port=port, autocommit=True) as conn:
+            # Create database if it doesn't exist
+            cur = await conn.execute("SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s", (dbname,))
+            exists = await cur.fetchone()
+            if not exists:
+                await conn.execute(f"CREATE DATABASE {dbname}")
 
         # Connect to the newly created or existing database
-        conn = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port)
-        cur = conn.cursor()
-
-        # Create tables
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                chat_id UUID PRIMARY KEY,
-                user_id UUID NOT NULL,
-                model VARCHAR(255) NOT NULL,
-                tokenizer_model VARCHAR(255),
-                system_message TEXT,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id SERIAL PRIMARY KEY,
-                chat_id UUID REFERENCES chat_sessions(chat_id),
-                role VARCHAR(50) NOT NULL,
-                content TEXT NOT NULL,
-                token_count INTEGER NOT NULL,
-                is_purged BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS function_calls (
-                id SERIAL PRIMARY KEY,
-                chat_id UUID REFERENCES chat_sessions(chat_id),
-                function_name VARCHAR(255) NOT NULL,
-                parameters JSONB,
-                response TEXT,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS chat_notes (
-                id SERIAL PRIMARY KEY,
-                message_id SERIAL REFERENCES chat_messages(id),
-                chat_id UUID REFERENCES chat_sessions(chat_id),
-                notes TEXT,
-                chat_summary TEXT,
-                metadata JSONB
-            )
-        """)
-
-        # Create the Trigger Function
-        cur.execute("""
-            CREATE OR REPLACE FUNCTION update_chat_sessions_timestamp()
-            RETURNS TRIGGER AS $$
-            BEGIN
-                -- Update only the `updated_at` column in the corresponding `chat_sessions` record
-                UPDATE chat_sessions
-                SET updated_at = CURRENT_TIMESTAMP
-                WHERE chat_id = NEW.chat_id;
-                RETURN NEW;
-            END;
-            $$ LANGUAGE plpgsql;
-        """)
-
-        # Create indexes
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id ON chat_messages(chat_id)
-        """)
-
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_function_calls_chat_id ON function_calls(chat_id)
-        """)
-
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_chat_notes_chat_id ON chat_notes(chat_id)
-        """)
-
-        tables_to_trigger = ['chat_notes', 'chat_messages', 'function_calls']  # Add other tables as needed
-
-        for table in tables_to_trigger:
-            trigger_name = f"trigger_update_chat_sessions_timestamp_{table}"
-            check_query = f"""
-                DO $$ 
+        db_config = {"dbname": dbname, "user": user, "password": password, "host": host, "port": port}
+        async with db.connection(db_config) as conn:
+            # Create tables
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    chat_id UUID PRIMARY KEY,
+                    user_id UUID NOT NULL,
+                    model VARCHAR(255) NOT NULL,
+                    tokenizer_model VARCHAR(255),
+                    system_message TEXT,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+            """, prepare=False)
+
+            # purge totals are kept on the session row by the message writer, so a session load doesn't scan its
+            # purged history. Sessions from before the columns existed get them backfilled once
+            cur = await conn.execute("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'chat_sessions' AND column_name = 'purged_message_count'
+            """, prepare=False)
+            backfill_purge_totals = await cur.fetchone() is None
+            await conn.execute("""
+                ALTER TABLE chat_sessions
+                ADD COLUMN IF NOT EXISTS purged_message_count INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS purged_token_count BIGINT NOT NULL DEFAULT 0
+            """, prepare=False)
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_messages (
+                    id SERIAL PRIMARY KEY,
+                    chat_id UUID REFERENCES chat_sessions(chat_id),
+                    role VARCHAR(50) NOT NULL,
+                    content TEXT NOT NULL,
+                    token_count INTEGER NOT NULL,
+                    is_purged BOOLEAN DEFAULT FALSE,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+            """, prepare=False)
+
+            if backfill_purge_totals:
+                await conn.execute("""
+                    UPDATE chat_sessions s
+                    SET purged_message_count = p.message_count, purged_token_count = p.token_count
+                    FROM (
+                        SELECT chat_id, count(*) AS message_count, sum(token_count) AS token_count
+                        FROM chat_messages
+                        WHERE is_purged
+                        GROUP BY chat_id
+                    ) p
+                    WHERE s.chat_id = p.chat_id
+                """, prepare=False)
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS function_calls (
+                    id SERIAL PRIMARY KEY,
+                    chat_id UUID REFERENCES chat_sessions(chat_id),
+                    function_name VARCHAR(255) NOT NULL,
+                    parameters JSONB,
+                    response TEXT,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+            """, prepare=False)
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_notes (
+                    id SERIAL PRIMARY KEY,
+                    message_id SERIAL REFERENCES chat_messages(id),
+                    chat_id UUID REFERENCES chat_sessions(chat_id),
+                    notes TEXT,
+                    chat_summary TEXT,
+                    metadata JSONB
+                )
+            """, prepare=False)
+
+            # Create the Trigger Function
+            await conn.execute("""
+                CREATE OR REPLACE FUNCTION update_chat_sessions_timestamp()
+                RETURNS TRIGGER AS $$
                 BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1 
-                        FROM pg_trigger 
-                        WHERE tgname = '{trigger_name}'
-                    ) THEN
-                        CREATE TRIGGER {trigger_name}
-                        AFTER INSERT ON {table}
-                        FOR EACH ROW
-                        EXECUTE FUNCTION update_chat_sessions_timestamp();
-                    END IF;
-                END $$;
-            """
-            cur.execute(check_query)
-
-        # Commit changes and close connection
-        conn.commit()
-        cur.close()
-        conn.close()
+                    -- Update only the `updated_at` column in the corresponding `chat_sessions` record
+                    UPDATE chat_sessions
+                    SET updated_at = CURRENT_TIMESTAMP
+                    WHERE chat_id = NEW.chat_id;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+            """, prepare=False)
+
+            # Create indexes
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id ON chat_messages(chat_id)
+            """, prepare=False)
+
+            # session loads only read the active window
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_chat_messages_active ON chat_messages(chat_id, created_at, id) WHERE NOT is_purged
+            """, prepare=False)
+
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_chat_messages_purged ON chat_messages(chat_id, created_at, id) WHERE is_purged
+            """, prepare=False)
+
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_function_calls_chat_id ON function_calls(chat_id)
+            """, prepare=False)
+
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_chat_notes_chat_id ON chat_notes(chat_id)
+            """, prepare=False)
+
+            tables_to_trigger = ['chat_notes', 'chat_messages', 'function_calls']  # Add other tables as needed
+
+            for table in tables_to_trigger:
+                trigger_name = f"trigger_update_chat_sessions_timestamp_{table}"
+                check_query = f"""
+                    DO $$ 
+                    BEGIN
+                        IF NOT EXISTS (
+                            SELECT 1 
+                            FROM pg_trigger 
+                            WHERE tgname = '{trigger_name}'
+                        ) THEN
+                            CREATE TRIGGER {trigger_name}
+                            AFTER INSERT ON {table}
+                            FOR EACH ROW
+                            EXECUTE FUNCTION update_chat_sessions_timestamp();
+                        END IF;
+                    END $$;
+                """
+                await conn.execute(check_query, prepare=False)
 
         logger.info("Database '{dbname}' and tables have been initialized successfully.", dbname=dbname)
 
-    def _load_chat_messages_rag(self):
+    async def _load_chat_messages_rag(self):
         """
-        Loads chat messages from the database and bulk inserts them into the conversation_rag index.
+        Backfills the user's chat messages into the shared conversation_rag index, only needed when the user has
+        no rows there yet since new messages are inserted as they are added.
         Messages are formatted as '[timestamp] role: content' for searchability.
         """
+        if await self.conversation_rag.count() > 0:
+            logger.debug("Conversation RAG already populated for user {user_id}", user_id=self.user_id)
+            return
+
         # Query to get all messages for this chat session
-        self.cur.execute("""
+        rows = await db.fetchall(self.db_config, """
             SELECT chat_messages.*
             FROM chat_messages
             JOIN chat_sessions on chat_messages.chat_id = chat_sessions.chat_id
@@ -286,15 +349,17 @@ class ChatBot:
         
         # Format messages for RAG insertion, excluding system messages
         rag_entries = []
-        for row in self.cur.fetchall():
+        rag_chat_ids = []
+        for row in rows:
             if row[2] != "system":  # Skip system messages
                 timestamp = row[7].strftime("%Y-%m-%d %H:%M:%S")
                 formatted_message = f"[{timestamp}] {row[2]}: {row[3]}"
                 rag_entries.append((formatted_message, None))  # None for metadata as per VectorSearch.bulk_insert
+                rag_chat_ids.append(str(row[1]))
         
         # Bulk insert into conversation_rag if we have entries
         if len(rag_entries) > 0:
-            self.conversation_rag.bulk_insert(rag_entries)
+            await self.conversation_rag.bulk_insert(rag_entries, chat_ids=rag_chat_ids)
             logger.info("Loaded {count} messages into conversation RAG", count=len(rag_entries))
         else:
             logger.debug("No messages to load into conversation RAG")
@@ -307,32 +372,52 @@ class ChatBot:
                 tool_fn = self.functions[tool_name]
                 tool_signature = utils.format_function_schema(tool_fn['schema'])
                 tools.append((f"{tool_signature[0]}: {tool_fn['schema']['function']['description']}\n\nTool Group Description: {tool_fn['tool_desc']}\n", None))
-        self.tool_rag.bulk_insert(tools)
+        self.tool_index.build(tools)
     
     async def _get_tool_suggestions(self):
-        transcript_snippet = "\n\n".join([f"{m['role']}: {m['content']}" for m in self.messages[-2:] if m.get('role', 'system') != 'system'])
+        transcript_snippet = "\n\n".join([f"{m.role}: {m.content}" for m in self.messages.tail(2) if m.role != 'system'])
         response = await self.get_llm_response(messages=[
             {"role": "system", "content": TOOL_RAG_QUERY_GENERATOR_PROMPT},
             {"role": "user", "content": f"<current_conversation_context>{transcript_snippet}</current_conversation_context>"}
-        ], model_name="meta-llama/llama-3.1-8b-instruct")
-        tool_suggestions = self.tool_rag.query(response.choices[0].message.content, top_k=15, min_p=0.2)
+        ], profile="tool_query")
+        tool_suggestions = await self.tool_index.aquery(response.choices[0].message.content, top_k=15, min_p=0.2)
         logger.debug("tool_caller_tool_suggestions(top {top_k}) {message}", top_k=15, message=tool_suggestions)
         return "\n\n".join([i['content'] for i in tool_suggestions[:5]])
 
-    async def _agent_loop(self):
+    async def _get_turn_context(self, key: str, get_context: Callable[[], Awaitable]):
+        """Returns the memoized value for key, computing it at most once per user turn."""
+        if key not in self.turn_context:
+            self.turn_context[key] = asyncio.ensure_future(get_context())
+        try:
+            return await self.turn_context[key]
+        except Exception:
+            self.turn_context.pop(key, None)
+            raise
+
+    async def _prepare_context(self):
+        """
+        Context preparation stage for one agent loop step. Tool suggestions and previous chat context are reused
+        across recursion steps of the same turn, rolling memory runs every step, and all branches run concurrently.
+        """
+        tool_suggestions_str, previous_chat_context, _ = await asyncio.gather(
+            self._get_turn_context("tool_suggestions", self._get_tool_suggestions),
+            self._get_turn_context("previous_chat_context", lambda: self.conversation_rag.hybrid_query(self.messages[-1].content, top_k=15)),
+            self.rolling_memory(),
+        )
+        logger.debug("previous_chat_context {context}", context=previous_chat_context)
+        # conversation_rag rows are '[timestamp] role: content' lines
+        return tool_suggestions_str, "\n".join(item['content'] for item in previous_chat_context)
+
+    async def _agent_loop(self, on_delta: Optional[Callable[..., Awaitable[None]]] = None):
         self_recurse = True
         recursion_counter = 0
         processing_tool_call = []
         while self_recurse and recursion_counter < self.max_recurse_depth:
             logger.debug("agent loop recursion depth: {count}", count=recursion_counter)
             
-            tool_suggestions_str = await self._get_tool_suggestions()
-            previous_chat_context = self.conversation_rag.query("\n".join([""]), top_k=15, min_p=0.2)
-            logger.debug("previous_chat_context {context}", context=previous_chat_context)
-            
-            self.rolling_memory()
+            tool_suggestions_str, previous_chat_context = await self._prepare_context()
             try:
-                parsed_response: AssistantResponse = await self.execute(tool_suggestions_str, [])
+                parsed_response: AssistantResponse = await self.execute(tool_suggestions_str, previous_chat_context, on_delta=on_delta)
             except Exception as e:
                 logger.debug("failed parsing assistant response {error}", error=e)
                 parsed_response: AssistantResponse = AssistantResponse.model_validate_json(json.dumps({
@@ -344,6 +429,7 @@ class ChatBot:
                     })
                 )
             
+            early_tool_calls = self._take_early_tool_calls()
             recursion_counter += 1
             llm_thought = f"<thought>{parsed_response.thought}</thought>"
 
@@ -352,19 +438,11 @@ class ChatBot:
                 tool_calls = parsed_response.response.content
                 if isinstance(parsed_response.response.content, str):
                     tool_calls = json.loads(parsed_response.response.content)
-                self._add_message({"role": "assistant", "content": f"{llm_thought}\n<tool_use>\n{[tooly.model_dump() for tooly in parsed_response.response.content]}\n</tool_use>"})
+                await self._add_message({"role": "assistant", "content": f"{llm_thought}\n<tool_use>\n{[tooly.model_dump() for tooly in parsed_response.response.content]}\n</tool_use>"})
                 
                 if len(tool_calls) > 0:
                     logger.info("Extracted tool calls count: {count}", count=len(tool_calls))
-                    tool_call_responses = []
-                    for tool_call in tool_calls:
-                        try:
-                            fn_success, fn_response = await self._execute_function_call(tool_call)
-                            if fn_success is False:
-                                needs_critic_review = True
-                            tool_call_responses.append(fn_response)
-                        except Exception as e:
-                            tool_call_responses.append(f"command: {tool_call} failed. Error: {e}")
+                    tool_call_responses, needs_critic_review = await self._execute_tool_calls(tool_calls, early_tool_calls)
                     response = {"role": "tool", "content": f"<tool_call_response>\n{tool_call_responses}\n</tool_call_response>"}
                     processing_tool_call.append(response)
                 else:
@@ -379,36 +457,35 @@ class ChatBot:
             if parsed_response.response.type  == ResponseType.INTERNAL_RESPONSE:
                 response = {"role": "assistant", "content": f"{llm_thought}\n<internal_response>{parsed_response.response.content}</internal_response>"}
 
+            await self._drain_early_tool_calls(early_tool_calls)
+
             # if (response in self.messages[-3:]) or needs_critic_review:
             #     response = await self._get_critic_feedback()
-            self._add_message(response)
+            await self._add_message(response)
             logger.info("Assistant_response {response}", response=response)
 
         return response
 
-    def _create_session(self, model, chat_id, tokenizer_model, system):
+    async def _create_session(self, model, chat_id, tokenizer_model, system):
         self.chat_id = chat_id
         self.system = {"role": "system", "content": system}
         self.model = model
         self.tokenizer_model = tokenizer_model if tokenizer_model != "" else model
-        self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_model)
-        self.purged_messages = []
-        self.purged_messages_token_count = []
-        self.messages = []
-        self.messages_token_counts = []
-        self.total_messages_tokens = 0
-
-        self.cur.execute("""
+        # loading a tokenizer reads files and can download them, keep it off the event loop
+        self.tokenizer = await asyncio.to_thread(AutoTokenizer.from_pretrained, self.tokenizer_model)
+        self.messages = MessageWindow()
+        self.purged_message_count = 0
+        self.purged_token_count = 0
+
+        await db.execute(self.db_config, """
             INSERT INTO chat_sessions (chat_id, user_id, model, tokenizer_model, system_message)
             VALUES (%s, %s, %s, %s, %s)
         """, (self.chat_id, self.user_id, self.model, self.tokenizer_model, self.system["content"]))
-        self.conn.commit()
 
-        self._load_tools_rag()
-        self._load_chat_messages_rag()
+        await self._load_chat_messages_rag()
         
         # Add initial system message
-        self._add_message(self.system)
+        await self._add_message(self.system)
         logger.info({
             "event": "ChatBot_initialized",
             "model": self.model,
@@ -417,21 +494,21 @@ class ChatBot:
         })
         logger.debug("Initial_system_message {sys_msg}", sys_msg=self.system)
     
-    def _load_session(self, chat_id: str, session_data: List):
+    async def _load_session(self, chat_id: str, session_data: List):
         """
-        Reconstructs the complete chat session state from the database using the chat_id.
-        Must be called right after ChatBot.__init__() to load an existing session.
+        Reconstructs the chat session state from the database using the chat_id.
+        Called by ChatBot.create() to load an existing session.
+
+        Only the active (non-purged) window is loaded, purged history is summarized by the message and token
+        totals kept on the chat_sessions row and can be read page by page with iter_purged_messages(), so
+        loading cost doesn't grow with the age of the session.
         
         Args:
             chat_id (str): UUID of the chat session to load
         """
 
         # Reset any existing state
-        self.purged_messages = []
-        self.purged_messages_token_count = []
-        self.messages = []
-        self.messages_token_counts = []
-        self.total_messages_tokens = 0
+        self.messages = MessageWindow()
         
         # Update instance variables with session data
         self.model = session_data[0]
@@ -440,38 +517,42 @@ class ChatBot:
         
         # Reinitialize tokenizer with correct model
         if self.tokenizer_model:
-            self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_model)
+            self.tokenizer = await asyncio.to_thread(AutoTokenizer.from_pretrained, self.tokenizer_model)
         
-        # Load all messages in chronological order
-        self.cur.execute("""
-            SELECT role, content, token_count, is_purged, created_at 
+        # Load the active messages in chronological order, including ones still queued in the writer
+        await self.message_writer.flush()
+        messages = await db.fetchall(self.db_config, """
+            SELECT id, role, content, token_count, created_at 
             FROM chat_messages 
-            WHERE chat_id = %s 
+            WHERE chat_id = %s AND NOT is_purged
             ORDER BY created_at, id
         """, (chat_id,))
-        messages = self.cur.fetchall()
+        self.purged_message_count, self.purged_token_count = await db.fetchone(self.db_config, """
+            SELECT purged_message_count, purged_token_count
+            FROM chat_sessions
+            WHERE chat_id = %s
+        """, (chat_id,))
         
         # Reconstruct messages and token counts
-        for role, content, token_count, is_purged, _ in messages:
-            message = {"role": role, "content": content}
+        for message_id, role, content, token_count, created_at in messages:
+            message = Message(role, content, message_id, token_count, created_at)
             
-            if is_purged:
-                self.purged_messages.append(message)
-                self.purged_messages_token_count.append(token_count)
+            if role == "system" and self.messages.system is None and len(self.messages) == 0:
+                self.messages.pin(message)
             else:
                 self.messages.append(message)
-                self.messages_token_counts.append(token_count)
-                self.total_messages_tokens += token_count
+        # sessions from before the system message was pinned may have purged it
+        if self.messages.system is None:
+            self.messages.pin(Message("system", self.system["content"], token_count=len(self.tokenizer.encode(str(self.system)))))
         
         # Load latest chat notes
-        self.cur.execute("""
+        notes_data = await db.fetchone(self.db_config, """
             SELECT notes, chat_summary, metadata 
             FROM chat_notes 
             WHERE chat_id = %s 
             ORDER BY id DESC 
             LIMIT 1
         """, (chat_id,))
-        notes_data = self.cur.fetchone()
         
         # No need to store notes in instance variables as they're only used 
         # when explicitly requested via _get_chat_notes() or _get_session_notes()
@@ -480,38 +561,56 @@ class ChatBot:
             "event": "Session_loaded",
             "chat_id": chat_id,
             "active_messages": len(self.messages),
-            "purged_messages": len(self.purged_messages),
-            "total_tokens": self.total_messages_tokens
+            "purged_messages": self.purged_message_count,
+            "purged_tokens": self.purged_token_count,
+            "total_tokens": self.messages.total_tokens
         })
-        logger.debug("Session_state {active_messages} {purged_messages}",
-            active_messages=self.messages,
-            purged_messages=self.purged_messages
-        )
+        logger.debug("Session_state {active_messages}", active_messages=self.messages)
         logger.info("ChatBot_initialized with {model}", model=self.model)
 
-    def _add_message(self, message):
-        self.messages.append(message)
-        token_count = len(self.tokenizer.encode(str(self.messages[-1])))
-        self.messages_token_counts.append(token_count)
-        self.total_messages_tokens = sum(self.messages_token_counts)
-        
-        self.cur.execute("""
-            INSERT INTO chat_messages (chat_id, role, content, token_count)
-            VALUES (%s, %s, %s, %s)
-            RETURNING *
-        """, (self.chat_id, message['role'], message['content'], token_count))
-        added_message = self.cur.fetchone()
+    async def iter_purged_messages(self, page_size: int = 100) -> AsyncIterator[Message]:
+        """
+        Yields the session's purged messages oldest first, fetching page_size rows per query with keyset
+        pagination on (created_at, id) so every page is an index range scan.
+        """
+        # messages purged by rolling_memory are only marked once the writer flushes
+        await self.message_writer.flush()
+        cursor = None
+        while True:
+            after_sql, after_params = ("AND (created_at, id) > (%s, %s)", cursor) if cursor is not None else ("", ())
+            rows = await db.fetchall(self.db_config, f"""
+                SELECT id, role, content, token_count, created_at
+                FROM chat_messages
+                WHERE chat_id = %s AND is_purged {after_sql}
+                ORDER BY created_at, id
+                LIMIT %s
+            """, (self.chat_id, *after_params, page_size))
+            for message_id, role, content, token_count, created_at in rows:
+                yield Message(role, content, message_id, token_count, created_at)
+            if len(rows) < page_size:
+                return
+            cursor = (rows[-1][4], rows[-1][0])
+
+    async def _add_message(self, message):
+        """Adds a {"role", "content"} message to the window, the session's system message gets pinned."""
+        token_count = len(self.tokenizer.encode(str(message)))
+        created_at = datetime.datetime.now(datetime.timezone.utc)
 
         # Format messages for RAG insertion, excluding system messages
-        if added_message[2] != "system":  # Skip system messages
-            timestamp = added_message[7].strftime("%Y-%m-%d %H:%M:%S")
-            formatted_message = f"[{timestamp}] {added_message[2]}: {added_message[3]}"
-            self.conversation_rag.insert(formatted_message, None)
-            logger.info(f"Loaded message into conversation RAG, message_id: {added_message[0]}")
-
-        self.conn.commit()
-        logger.debug("Added_message: {message}, token_count {token_count}, total_tokens {total_tokens} self.total_messages_tokens", message=message, token_count=token_count, total_tokens=self.total_messages_tokens)
-        return added_message[0]
+        rag = None
+        if message['role'] != "system":  # Skip system messages
+            timestamp = created_at.strftime("%Y-%m-%d %H:%M:%S")
+            rag = (self.conversation_rag, f"[{timestamp}] {message['role']}: {message['content']}")
+
+        # queued with a preallocated id, the insert, commit and embedding happen in the background writer
+        message_id = await self.message_writer.add_message(self.chat_id, message['role'], message['content'], token_count, created_at, rag=rag)
+        stored_message = Message(message['role'], message['content'], message_id, token_count, created_at)
+        if message is self.system:
+            self.messages.pin(stored_message)
+        else:
+            self.messages.append(stored_message)
+        logger.debug("Added_message: {message}, token_count {token_count}, total_tokens {total_tokens} self.total_messages_tokens", message=message, token_count=token_count, total_tokens=self.messages.total_tokens)
+        return message_id
 
     async def _get_bot_response_json(self, response_text: str):
         logger.debug("structuring bot response into JSON: {response_text}", response_text=response_text)
@@ -519,9 +618,9 @@ class ChatBot:
             {"role": "system", "content": BOT_RESPONSE_FORMATTER_PROMPT},
             {"role": "user", "content": response_text}
         ]
-        response = await self.get_fireworks_llm_response(
+        response = await self.get_llm_response(
             messages=response_formatter_messages,
-            model_name="accounts/fireworks/models/llama-v3p1-8b-instruct",
+            profile="formatter",
             extra_body={
                 "response_format": {
                     "type": "json_object",
@@ -535,14 +634,14 @@ class ChatBot:
     async def _get_critic_feedback(self):
         logger.debug("getting critic feedback for the current conversation")
         agent_transcript = f"system: {self.system}\n\n...[possible conversation turns]...\n\n"
-        agent_transcript += "\n".join([f"{m['role']}: {m['content']}" for m in self.messages[-3:] if m.get('role', 'system') != 'system'])
+        agent_transcript += "\n".join([f"{m.role}: {m.content}" for m in self.messages.tail(3) if m.role != 'system'])
         response_formatter_messages = [ 
             {"role": "system", "content": CRITIC_PROMPT_V1},
             {"role": "user", "content": f"<current_conversation_transcript>\n{agent_transcript}\n<current_conversation_transcript>"}
         ]
         response = await self.get_llm_response(
             messages=response_formatter_messages,
-            model_name="google/gemini-flash-1.5-8b",
+            profile="critic",
             extra_body={
                 "response_format": {
                     "type": "json_object",
@@ -556,9 +655,23 @@ class ChatBot:
             "content": f"<thought>{ass_resp.thought}</thought>\n<internal_response>{ass_resp.internal_response}</internal_response>"
         }
 
-    async def _parse_results(self, response_text: str):
-        assistant_response = await self._get_bot_response_json(response_text)
+    async def _parse_results(self, response_text: str, response_parser: Optional[ResponseStreamParser] = None):
+        try:
+            if response_parser is not None:
+                assistant_response = response_parser.to_assistant_response()
+            else:
+                assistant_response = parse_assistant_response(response_text)
+            self.response_parse_stats["local"] += 1
+        except Exception as e:
+            logger.warning("local response parsing failed, falling back to llm formatter {error}", error=e)
+            try:
+                assistant_response = await self._get_bot_response_json(response_text)
+                self.response_parse_stats["llm_formatter"] += 1
+            except Exception:
+                self.response_parse_stats["failed"] += 1
+                raise
         logger.debug("assistant_response_json {response_json}", response_json=assistant_response.model_dump())
+        logger.info("Response_parse_stats {stats}", stats=self.response_parse_stats)
         return assistant_response
 
     def _extract_function_calls(self, xml_response):
@@ -591,7 +704,7 @@ class ChatBot:
         return tool_calls
 
     async def _get_context_filtered_tool_results(self, tool_call: ToolParameter, tool_result):
-        context_messages = [m for m in self.messages[-2:] if m.get('role', 'system') != 'system']
+        context_messages = [m.to_dict() for m in self.messages.tail(2) if m.role != 'system']
         logger.debug("context_filtered_tool_result {tool_call_result} {conversation_context}", tool_call_result=tool_result, conversation_context=context_messages)
         response_formatter_messages = [
             {"role": "system", "content": CONTEXT_FILTERED_TOOL_RESULT_PROMPT},
@@ -599,13 +712,70 @@ class ChatBot:
         ]
         response = await self.get_llm_response(
             messages=response_formatter_messages,
-            model_name="openai/gpt-4o-mini",
+            profile="tool_filter",
             extra_body={"response_format": {"type": "json_object"}}
         )
         logger.debug("context_filtered_tool_result {reformatted_tool_result}", reformatted_tool_result=response.choices[0].message.content)
 
         return response.choices[0].message.content.replace("\n", " ").replace("\t", "")
 
+    def _take_early_tool_calls(self):
+        early_tool_calls, self.early_tool_calls = self.early_tool_calls, []
+        return early_tool_calls
+
+    def _pop_early_tool_call(self, tool_call: ToolParameter, early_tool_calls: List[tuple[ToolParameter, asyncio.Task]]) -> Optional[asyncio.Task]:
+        """Returns the already running task for an identical tool call, if the stream dispatched one."""
+        if not isinstance(tool_call, ToolParameter):
+            return None
+        for idx, (early_tool_call, task) in enumerate(early_tool_calls):
+            if early_tool_call.name == tool_call.name and early_tool_call.parameters == tool_call.parameters:
+                early_tool_calls.pop(idx)
+                return task
+        return None
+
+    async def _drain_early_tool_calls(self, early_tool_calls: List[tuple[ToolParameter, asyncio.Task]]):
+        """
+        Early calls that didn't end up in the parsed response (e.g. a retried completion) already had their side
+        effects, so they are awaited and logged rather than cancelled.
+        """
+        if len(early_tool_calls) == 0:
+            return
+        logger.warning("Unused_early_tool_calls {tool_calls}", tool_calls=[tool_call for tool_call, _ in early_tool_calls])
+        await asyncio.gather(*[task for _, task in early_tool_calls], return_exceptions=True)
+        early_tool_calls.clear()
+
+    async def _execute_tool_calls(self, tool_calls: List[ToolParameter], early_tool_calls: Optional[List[tuple[ToolParameter, asyncio.Task]]] = None):
+        """
+        Runs all tool calls from one tool_use block, concurrently when parallel_tool_calls is set.
+        Tool calls that were already dispatched while the completion streamed reuse their running task.
+        Responses are returned in the same order as the tool calls.
+        """
+        early_tool_calls = early_tool_calls if early_tool_calls is not None else []
+        if self.parallel_tool_calls:
+            results = await asyncio.gather(*[
+                self._pop_early_tool_call(tool_call, early_tool_calls) or self._execute_function_call(tool_call)
+                for tool_call in tool_calls
+            ], return_exceptions=True)
+        else:
+            results = []
+            for tool_call in tool_calls:
+                try:
+                    results.append(await self._execute_function_call(tool_call))
+                except Exception as e:
+                    results.append(e)
+
+        tool_call_responses = []
+        needs_critic_review = False
+        for tool_call, result in zip(tool_calls, results):
+            if isinstance(result, Exception):
+                tool_call_responses.append(f"command: {tool_call} failed. Error: {result}")
+                continue
+            fn_success, fn_response = result
+            if fn_success is False:
+                needs_critic_review = True
+            tool_call_responses.append(fn_response)
+        return tool_call_responses, needs_critic_review
+
     async def _execute_function_call(self, tool_call: ToolParameter):
         logger.info("Executing_function_call {tool_call}", tool_call=tool_call)
         success = False
@@ -614,7 +784,7 @@ class ChatBot:
 
             logger.debug("Function_call_details {name} {args}", name=tool_call.name, args=tool_call.parameters)
             try:
-                function_response = function_to_call.func(**tool_call.parameters)
+                function_response = await self.tool_dispatcher.run(tool_call.name, function_to_call.func, tool_call.parameters)
                 logger.info("filtering function call response {name} {result}", name=tool_call.name, result=function_response)
                 function_response = await self._get_context_filtered_tool_results(tool_call, function_response)
                 logger.debug("filtered function call response {name} {result}", name=tool_call.name, result=function_response)
@@ -626,11 +796,7 @@ class ChatBot:
             logger.debug("Function_call_response {response}", response=results_dict)
             
             # Log function call in database
-            self.cur.execute("""
-                INSERT INTO function_calls (chat_id, function_name, parameters, response)
-                VALUES (%s, %s, %s, %s)
-            """, (self.chat_id, tool_call.name, Json(tool_call.parameters), str(function_response)))
-            self.conn.commit()
+            self.message_writer.add_function_call(self.chat_id, tool_call.name, tool_call.parameters, str(function_response))
             return success, results_dict
         else:
             logger.warning("Invalid_function_name {name}", name=tool_call.name)
@@ -638,27 +804,22 @@ class ChatBot:
 
     async def _get_chat_notes(self, message_id: str):
 
-        self.cur.execute("""
+        previous_notes = await db.fetchone(self.db_config, """
                     SELECT notes FROM public.chat_notes
                     WHERE chat_id=%s
                     ORDER BY id DESC LIMIT 1
                 """, (self.chat_id,))
-        previous_notes = self.cur.fetchone()
         previous_notes = previous_notes[0] if previous_notes is not None else ""
 
         chat_transcript = ""
         for turn in self.messages:
-            if turn.get('type', '') == "function_call":
-                pass
-                # print(f"{turn['type']}: {turn['name']}: {turn['parameters']}: {turn['response']}")
-            else:
-                if turn['role'].lower() != "system":
-                    chat_transcript += f"{turn['role'].upper()}:\n{turn['content']}\n"
+            if turn.role.lower() != "system":
+                chat_transcript += f"{turn.role.upper()}:\n{turn.content}\n"
         messages = [
             {"role": "system", "content": CHAT_NOTES_PROMPT},
             {"role": "user", "content": f"extract information from the following conversation:\n<previous_notes>{previous_notes}</previous_notes>\n\n<conversation_transcript>{chat_transcript}</conversation_transcript>"}
         ]
-        completion = await self.get_llm_response(messages, model_name=self.model)
+        completion = await self.get_llm_response(messages, profile="notes")
 
         logger.debug("parsing_chat_notes_llm_response {response_text}", response_text=completion)
         response_text = utils.sanitize_inner_content(completion.choices[0].message.content)
@@ -680,27 +841,27 @@ class ChatBot:
                 notes.append(element.text)
         parsed_resp['notes'] = (previous_notes + "\n" + "\n".join(notes).strip()).strip()
 
-        notes_id = self.cur.execute("""
+        # message_id references chat_messages, make sure it has been written
+        await self.message_writer.flush()
+        notes_id = await db.fetchone(self.db_config, """
             INSERT INTO chat_notes (message_id, chat_id, notes, chat_summary, metadata)
             VALUES (%s, %s, %s, %s, %s)
             RETURNING id
-        """, (message_id, self.chat_id, parsed_resp['notes'], "", Json({"model": self.model, "provider": str(self.openai_client.base_url)})))
-        self.conn.commit()
+        """, (message_id, self.chat_id, parsed_resp['notes'], "", Jsonb({"model": self.model, "provider": str(self.openai_client.base_url)})))
 
     async def _get_session_notes(self, message_id: str):
-        self.cur.execute("""
+        latest_session_notes = await db.fetchone(self.db_config, """
                     SELECT notes FROM public.chat_notes
                     WHERE chat_id=%s
                     ORDER BY id DESC LIMIT 1
                 """, (self.chat_id,))
-        latest_session_notes = self.cur.fetchone()
         latest_session_notes = latest_session_notes[0] if latest_session_notes is not None else ""
 
         messages = [
             {"role": "system", "content": CHAT_SESSION_NOTES_PROMPT},
             {"role": "user", "content": f"<chat_session_notes>{latest_session_notes}</chat_session_notes>"}
         ]
-        completion = await self.get_llm_response(messages, model_name=self.model)
+        completion = await self.get_llm_response(messages, profile="notes")
 
         logger.debug("parsing_session_end_notes_llm_response {response_text}", response_text=completion)
         response_text = utils.sanitize_inner_content(completion.choices[0].message.content)
@@ -722,16 +883,24 @@ class ChatBot:
                 notes.append(element.text)
         parsed_resp['notes'] = (latest_session_notes + "\n" + "\n".join(notes).strip()).strip()
 
-        notes_id = self.cur.execute("""
+        # message_id references chat_messages, make sure it has been written
+        await self.message_writer.flush()
+        notes_id = await db.fetchone(self.db_config, """
             INSERT INTO chat_notes (message_id, chat_id, notes, chat_summary, metadata)
             VALUES (%s, %s, %s, %s, %s)
             RETURNING id
-        """, (message_id, self.chat_id, parsed_resp['notes'], "", Json({"model": self.model, "provider": str(self.openai_client.base_url)})))
-        self.conn.commit()
+        """, (message_id, self.chat_id, parsed_resp['notes'], "", Jsonb({"model": self.model, "provider": str(self.openai_client.base_url)})))
 
-    async def execute(self, tool_suggestions, previous_chat_context, retries: int = 3):
+    async def execute(self, tool_suggestions, previous_chat_context, retries: int = 3, on_delta: Optional[Callable[..., Awaitable[None]]] = None):
         # prefs = "\t-".join([i for i in USER_INFO['preferences']])
-        
+        error = None
+        attempt = 0
+        streamed_text = False
+        async def forward_delta(delta: str):
+            nonlocal streamed_text
+            streamed_text = True
+            await on_delta(delta)
+
         while retries > 0:
             current_info = f'''
 ## Current Realtime Info
@@ -758,92 +927,242 @@ Preferences:
                 self.system['content'] = regex.sub(current_info, self.system['content'])
             else:
                 self.system['content'] = self.system['content'] + '\n' + current_info
-            self.messages[0] = self.system
+            # re-pin with a fresh token count, the running total rolling_memory trusts includes the realtime info
+            pinned = self.messages.system
+            self.messages.pin(Message(
+                "system",
+                self.system['content'],
+                pinned.id if pinned is not None else None,
+                len(self.tokenizer.encode(str(self.system))),
+                pinned.created_at if pinned is not None else None
+            ))
+            await self.rolling_memory()
         
             logger.info("Executing_LLM_call {message_count}", message_count=len(self.messages))
-            completion = await self.get_llm_response(messages=self.messages, model_name=self.model)
-            logger.debug("LLM_response {response}", response=completion.model_dump())
-            logger.info("Token_usage {usage}", usage=completion.usage.model_dump())
+            response_parser = None
+            try:
+                if on_delta is not None or (self.early_tool_dispatch and self.parallel_tool_calls):
+                    response_text, response_parser = await self._stream_completion(forward_delta if on_delta is not None else None)
+                else:
+                    completion = await self.get_llm_response(messages=self.messages.render(), profile="main")
+                    logger.debug("LLM_response {response}", response=completion.model_dump())
+                    logger.info("Token_usage {usage}", usage=completion.usage.model_dump())
+                    response_text = completion.choices[0].message.content
+            except Exception as e:
+                # the call already went through the profile's retries, fallback model and provider failover
+                error = e
+                logger.error("bot response failed {error}", error=e)
+                break
 
+            # only a response that can't be parsed is worth asking for again
             try:
-                parsed_response = await self._parse_results(completion.choices[0].message.content)
+                parsed_response = await self._parse_results(response_text, response_parser)
                 return parsed_response
             except Exception as e:
-                logger.error("bot response failed {error}", error=e)
+                error = e
+                logger.error("bot response parsing failed {error}", error=e)
             retries -= 1
-        
-        return AssistantResponse.model_validate_json('''{
-            "thought": "[NOT AVAILBALE. THIS IS AN INJECTED MESSAGE BECAUSE OF INTERNAL LLM CALLING FAILURE]",
-            "response": {
-                "type": ResponseType.INTERNAL_RESPONSE,
-                "content": f"internal error happened trying to call llm. Error: {e}"
-            }'''
+            if retries > 0:
+                attempt += 1
+                await asyncio.sleep(self.llm_profiles["main"].backoff_delay(attempt - 1))
+                if streamed_text:
+                    # the retry streams the response again from the start
+                    await on_delta("", reset=True)
+                    streamed_text = False
+
+        return AssistantResponse.create_text_response(
+            "[NOT AVAILBALE. THIS IS AN INJECTED MESSAGE BECAUSE OF INTERNAL LLM CALLING FAILURE]",
+            f"internal error happened trying to call llm. Error: {error}",
+            is_user_response=False
         )
 
-    def rolling_memory(self):
-        initial_token_count = self.total_messages_tokens
-        while self.total_messages_tokens + self.max_reply_msg_tokens >= self.max_message_tokens:
-            purged_message = self.messages.pop(0)
-            purged_token_count = self.messages_token_counts.pop(0)
-
-            self.purged_messages.append(purged_message)
-            self.purged_messages_token_count.append(purged_token_count)
-
-            self.total_messages_tokens -= purged_token_count
+    async def _stream_completion(self, on_delta: Optional[Callable[..., Awaitable[None]]] = None):
+        """
+        Streams the main completion through a ResponseStreamParser. <response_to_user> text is forwarded to on_delta
+        and, with early_tool_dispatch, each tool call starts running as soon as it is complete in the stream.
+        Returns the full completion text and the parser holding its parsed state.
+        """
+        response_parser = ResponseStreamParser()
+        response_chunks = []
+        # calls dispatched by an earlier attempt of this step already ran, a retried stream reuses them
+        dispatched_tool_calls = list(self.early_tool_calls)
+        async for chunk in self.stream_llm_response(messages=self.messages.render(), profile="main"):
+            response_chunks.append(chunk)
+            await self._handle_parser_events(response_parser.feed(chunk), on_delta, dispatched_tool_calls)
+        await self._handle_parser_events(response_parser.close(), on_delta, dispatched_tool_calls)
+        response_text = "".join(response_chunks)
+        logger.debug("LLM_response {response}", response=response_text)
+        return response_text, response_parser
+
+    async def _handle_parser_events(
+        self,
+        events,
+        on_delta: Optional[Callable[..., Awaitable[None]]] = None,
+        dispatched_tool_calls: Optional[List[tuple[ToolParameter, asyncio.Task]]] = None
+    ):
+        dispatched_tool_calls = dispatched_tool_calls if dispatched_tool_calls is not None else []
+        for event in events:
+            if event.type == ParserEventType.RESPONSE_TO_USER_DELTA and on_delta is not None:
+                await on_delta(event.content)
+            elif event.type == ParserEventType.TOOL_USE_COMPLETE and self.early_tool_dispatch and self.parallel_tool_calls:
+                if self._pop_early_tool_call(event.content, dispatched_tool_calls) is not None:
+                    # still in self.early_tool_calls, the parsed response picks up its task from there
+                    logger.info("Early_dispatch_reused_tool_call {tool_call}", tool_call=event.content)
+                    continue
+                logger.info("Early_dispatch_tool_call {tool_call}", tool_call=event.content)
+                self.early_tool_calls.append((event.content, asyncio.create_task(self._execute_function_call(event.content))))
+
+    async def rolling_memory(self):
+        """
+        Purges the oldest messages until the history plus a reply fits the context. Only the ids purged by this
+        call are marked in the database, queued on the message writer as one batched UPDATE.
+        """
+        initial_token_count = self.messages.total_tokens
+        purged_ids = []
+        # the pinned system message is never evicted
+        while self.messages.total_tokens + self.max_reply_msg_tokens >= self.max_message_tokens and len(self.messages) > 1:
+            purged_message = self.messages.popleft()
+            if purged_message.id is not None:
+                purged_ids.append(purged_message.id)
+            self.purged_message_count += 1
+            self.purged_token_count += purged_message.token_count
             logger.debug("Purged_message {message}", message=purged_message)
 
-        if initial_token_count != self.total_messages_tokens:
+        if initial_token_count != self.messages.total_tokens:
             logger.info({
                 "event": "Rolling_memory",
                 "token_count_before": initial_token_count,
-                "token_count_after": self.total_messages_tokens
+                "token_count_after": self.messages.total_tokens
             })
             logger.debug("Current_message_history {messages}", messages=self.messages)
-            logger.debug("Purged_message_history {purged_messages}", messages=self.purged_messages)
-        try:
-            for purged_message in self.purged_messages:
-                self.cur.execute("""
-                    UPDATE chat_messages
-                    SET is_purged = TRUE
-                    WHERE chat_id = %s AND role = %s AND content = %s
-                """, (self.chat_id, purged_message['role'], purged_message['content']))
-            self.conn.commit()
-        except Exception as e:
-            logger.error("db update exception {error}", error=e)
-            raise
+            logger.debug("Purged_message_history {count} {tokens}", count=self.purged_message_count, tokens=self.purged_token_count)
+        if purged_ids:
+            self.message_writer.mark_purged(purged_ids)
 
-    async def get_llm_response(self, messages: List[Dict[str, str]], model_name: str, extra_body: Optional[dict] = None) -> ChatCompletion | BaseModel:
-        logger.debug("Sending_request_to_LLM {api_provider} {model} {messages}", api_provider=self.openai_client.base_url, model=model_name, messages=messages)
-        if "openrouter" in self.openai_client.base_url.host:
-            extra_body = extra_body if extra_body is not None else self.open_router_extra_body
-        try:
-            chat_completion = await self.openai_client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                max_tokens=self.max_reply_msg_tokens,
-                temperature=0.1,
-                extra_body= extra_body,
-            )
-        except Exception as e:
-            if e['code'] == 'model_not_available':
-                logger.error("model not found as requested: {model_name}", model_name=model_name)
-                raise(e)
-            else:
-                logger.error("failed to get llm response. Error: {ex}", ex=e)
-                raise(e)
+    async def _cached_completion(self, cache: Optional[str], model_name: str, messages: List[Dict[str, str]], params: dict, create_completion: Callable[[], Awaitable[ChatCompletion]]) -> ChatCompletion:
+        """
+        Serves a completion from the response cache when possible.
+
+        Args:
+            cache: None to skip the cache, "exact" for exact matches only, "semantic" to also match a similar last message
+            create_completion: Makes the actual LLM call on a cache miss
+        """
+        if cache is None:
+            return await create_completion()
+
+        embedding = None
+        if cache == "semantic":
+            embedding = await self.tool_index.aencode_query(messages[-1]["content"])
+        cached_completion = self.response_cache.lookup(model_name, messages, params, embedding)
+        logger.debug("LLM_cache_metrics {metrics}", metrics=self.response_cache.metrics)
+        if cached_completion is not None:
+            return ChatCompletion.model_validate(cached_completion)
+
+        completion = await create_completion()
+        self.response_cache.store(model_name, messages, params, completion.model_dump(), embedding)
+        return completion
+
+    async def _call_with_retries(self, call_profile: LLMCallProfile, model_name: str, make_call: Callable[[str], Awaitable[ChatCompletion]]) -> ChatCompletion:
+        """
+        Runs make_call(model) under the profile's deadline, retrying with jittered backoff and then trying the
+        profile's fallback model once.
+        """
+        attempts = [model_name] * (call_profile.retries + 1)
+        if call_profile.fallback_model is not None and call_profile.fallback_model != model_name:
+            attempts.append(call_profile.fallback_model)
+
+        error = None
+        for attempt, attempt_model in enumerate(attempts):
+            if attempt > 0:
+                await asyncio.sleep(call_profile.backoff_delay(attempt - 1))
+            try:
+                return await asyncio.wait_for(make_call(attempt_model), timeout=call_profile.timeout)
+            except Exception as e:
+                error = e
+                logger.warning("llm call attempt failed {model} {attempt} {error}", model=attempt_model, attempt=attempt, error=repr(e))
+        logger.error("failed to get llm response. Error: {ex}", ex=error)
+        raise error
+
+    async def get_llm_response(self, messages: List[Dict[str, str]], profile: str = "main", model_name: Optional[str] = None, extra_body: Optional[dict] = None) -> ChatCompletion | BaseModel:
+        """
+        Calls the LLM using a named call profile (see llm_profiles.json) for the model, token cap, deadline,
+        retries, fallback model, provider and cache mode. model_name overrides the profile's model.
+        """
+        call_profile = self.llm_profiles[profile]
+        model_name = model_name or call_profile.model or self.model
+        if call_profile.provider == "fireworks":
+            make_call = lambda model: self._get_fireworks_llm_response(messages, model, call_profile, extra_body)
+        else:
+            make_call = lambda model: self._get_llm_response(messages, model, call_profile, extra_body)
+
+        params = {"provider": call_profile.provider, "max_tokens": call_profile.max_tokens, "temperature": call_profile.temperature, "extra_body": extra_body}
+        return await self._cached_completion(call_profile.cache, model_name, messages, params, lambda: self._call_with_retries(call_profile, model_name, make_call))
+
+    async def _get_llm_response(self, messages: List[Dict[str, str]], model_name: str, call_profile: LLMCallProfile, extra_body: Optional[dict] = None) -> ChatCompletion:
+        logger.debug("Sending_request_to_LLM {api_providers} {model} {messages}", api_providers=[provider.name for provider in self.provider_pool.route(model_name)], model=model_name, messages=messages)
+        chat_completion = await self.provider_pool.chat_completion(
+            model=model_name,
+            messages=messages,
+            max_tokens=call_profile.max_tokens,
+            temperature=call_profile.temperature,
+            extra_body=extra_body,
+        )
         logger.debug("Received_response_from_LLM {completion}", completion=chat_completion.model_dump())
         return chat_completion
 
-    async def get_fireworks_llm_response(self, messages: List[dict], model_name: str = "accounts/fireworks/models/llama-v3p1-8b-instruct", extra_body: Optional[dict] = None):
+    async def stream_llm_response(self, messages: List[Dict[str, str]], profile: str = "main", model_name: Optional[str] = None, extra_body: Optional[dict] = None) -> AsyncIterator[str]:
+        """
+        Same request as get_llm_response but yields the completion text as it is decoded. The profile's deadline
+        covers the whole stream; attempts are only retried while nothing has been yielded yet.
+        """
+        call_profile = self.llm_profiles[profile]
+        model_name = model_name or call_profile.model or self.model
+        attempts = [model_name] * (call_profile.retries + 1)
+        if call_profile.fallback_model is not None and call_profile.fallback_model != model_name:
+            attempts.append(call_profile.fallback_model)
+
+        loop = asyncio.get_running_loop()
+        for attempt, attempt_model in enumerate(attempts):
+            if attempt > 0:
+                await asyncio.sleep(call_profile.backoff_delay(attempt - 1))
+            logger.debug("Streaming_request_to_LLM {api_providers} {model} {messages}", api_providers=[provider.name for provider in self.provider_pool.route(attempt_model)], model=attempt_model, messages=messages)
+            stream = self.provider_pool.stream_chat_completion(
+                model=attempt_model,
+                messages=messages,
+                max_tokens=call_profile.max_tokens,
+                temperature=call_profile.temperature,
+                extra_body=extra_body,
+                stream_options={"include_usage": True},
+            )
+            deadline = loop.time() + call_profile.timeout
+            yielded = False
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(anext(stream), timeout=max(deadline - loop.time(), 0))
+                    except StopAsyncIteration:
+                        return
+                    if chunk.usage is not None:
+                        logger.info("Token_usage {usage}", usage=chunk.usage.model_dump())
+                    if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                        yielded = True
+                        yield chunk.choices[0].delta.content
+            except Exception as e:
+                if yielded or attempt == len(attempts) - 1:
+                    logger.error("llm response stream failed. Error: {ex}", ex=repr(e))
+                    raise
+                logger.warning("llm stream attempt failed {model} {attempt} {error}", model=attempt_model, attempt=attempt, error=repr(e))
+
+    async def _get_fireworks_llm_response(self, messages: List[dict], model_name: str, call_profile: LLMCallProfile, extra_body: Optional[dict] = None):
         url = "https://api.fireworks.ai/inference/v1/chat/completions"
         payload = {
         "model": model_name,
-        "max_tokens": 4096,
+        "max_tokens": call_profile.max_tokens,
         "top_p": 1,
         "top_k": 40,
         "presence_penalty": 0,
         "frequency_penalty": 0,
-        "temperature": 0.6,
+        "temperature": call_profile.temperature,
         "messages": messages,
         "response_format": extra_body["response_format"]
         }
@@ -853,11 +1172,11 @@ Preferences:
         "Authorization": f"Bearer {FIREWORKS_API_KEY}"
         }
 
-        async with aiohttp.ClientSession() as session:
-            fir_resp = await session.post(url, headers=headers, json=payload)
-            try:
-                content = await fir_resp.json()
-                return ChatCompletion.model_validate(content)
-            except Exception as e:
-                logger.error("failed to get fireworks llm response with error: {e}", e=e)
-                raise(e)
\ No newline at end of file
+        fir_resp = await get_async_http_client(url).post(url, headers=headers, json=payload)
+        try:
+            fir_resp.raise_for_status()
+            content = fir_resp.json()
+            return ChatCompletion.model_validate(content)
+        except Exception as e:
+            logger.error("failed to get fireworks llm response with error: {e}", e=e)
+            raise(e)
\ No newline at end of file
@@ -1,5 +1,6 @@
 from typing import Union, List, Dict, Any, Literal
 from enum import Enum
+from dataclasses import dataclass
 from pydantic import BaseModel, Field, model_validator
 
 class ResponseType(str, Enum):
@@ -110,3 +111,10 @@ class MessageResponse:
     client_type: ClientType
     content: str
     raw_response: str
+
+@dataclass
+class MessageDelta:
+    client_type: ClientType
+    delta: str
+    # the text streamed so far for this response is stale (the completion is retried), drop it before this delta
+    reset: bool = False
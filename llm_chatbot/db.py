@@ -0,0 +1,81 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+from loguru import logger
+from psycopg import AsyncConnection
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+# pool bounds are per database and shared by every session and VectorSearch in the process
+MIN_POOL_SIZE = 2
+MAX_POOL_SIZE = 10
+# 0 prepares every statement on its first execution per connection, repeated queries then skip parse/plan
+PREPARE_THRESHOLD = 0
+
+_pools: Dict[str, AsyncConnectionPool] = {}
+_pools_lock: Optional[asyncio.Lock] = None
+
+
+def make_dsn(db_config: Dict[str, str]) -> str:
+    # sorted so equal configs built in a different key order share a pool
+    return make_conninfo(**dict(sorted(db_config.items())))
+
+
+async def get_pool(db_config: Dict[str, str]) -> AsyncConnectionPool:
+    """Process wide async connection pool for db_config, opened on first use."""
+    global _pools_lock
+    if _pools_lock is None:
+        _pools_lock = asyncio.Lock()
+    dsn = make_dsn(db_config)
+    async with _pools_lock:
+        if dsn not in _pools:
+            pool = AsyncConnectionPool(
+                dsn,
+                min_size=MIN_POOL_SIZE,
+                max_size=MAX_POOL_SIZE,
+                kwargs={"prepare_threshold": PREPARE_THRESHOLD},
+                open=False,
+            )
+            await pool.open()
+            _pools[dsn] = pool
+            logger.info("Opened db pool {host} {dbname}", host=db_config.get("host"), dbname=db_config.get("dbname"))
+        return _pools[dsn]
+
+
+@asynccontextmanager
+async def connection(db_config: Dict[str, str]) -> AsyncIterator[AsyncConnection]:
+    """Pooled connection for one transaction, committed on exit and rolled back on error."""
+    pool = await get_pool(db_config)
+    async with pool.connection() as conn:
+        yield conn
+
+
+async def fetchone(db_config: Dict[str, str], query: str, params: Optional[Sequence[Any]] = None) -> Optional[tuple]:
+    async with connection(db_config) as conn:
+        cur = await conn.execute(query, params)
+        return await cur.fetchone()
+
+
+async def fetchall(db_config: Dict[str, str], query: str, params: Optional[Sequence[Any]] = None) -> List[tuple]:
+    async with connection(db_config) as conn:
+        cur = await conn.execute(query, params)
+        return await cur.fetchall()
+
+
+async def execute(db_config: Dict[str, str], query: str, params: Optional[Sequence[Any]] = None, prepare: Optional[bool] = None) -> int:
+    """Run a statement in its own transaction and return the affected row count.
+
+    Args:
+        prepare: False for DDL and other one-off statements that shouldn't take a prepared statement slot
+    """
+    async with connection(db_config) as conn:
+        cur = await conn.execute(query, params, prepare=prepare)
+        return cur.rowcount
+
+
+async def close_pools():
+    """Close every pool, call on process shutdown."""
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        await pool.close()
@@ -0,0 +1,167 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import numpy as np
+from loguru import logger
+from psycopg import AsyncConnection
+
+from llm_chatbot import db
+
+PRECISION_DTYPES = {"float32": np.float32, "ubinary": np.uint8}
+
+CacheKey = Tuple[str, int, str, bytes]
+
+
+class EmbeddingCache:
+    def __init__(self, db_config: Dict[str, str], table_name: str = "embedding_cache", max_memory_entries: int = 50_000):
+        """Content hash keyed embedding cache persisted in postgres with an in-memory LRU in front.
+
+        Entries are keyed on (model, dimensions, precision, sha256(embed_type + text)) so the same text embedded
+        as a query and as a document are cached separately.
+
+        Args:
+            db_config: PostgreSQL connection parameters, the table is read and written through the shared pool
+            table_name: Table the cache is persisted in
+            max_memory_entries: Capacity of the in-memory LRU
+        """
+        self.db_config = db_config
+        self.table_name = table_name
+        self.max_memory_entries = max_memory_entries
+        self.memory: OrderedDict[CacheKey, np.ndarray] = OrderedDict()
+        self.metrics = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._table_ready = False
+
+    @asynccontextmanager
+    async def _connection(self, conn: Optional[AsyncConnection] = None) -> AsyncIterator[AsyncConnection]:
+        """conn when the caller already holds one, so it doesn't wait on the pool for a second, else a pooled one."""
+        if conn is not None:
+            yield conn
+            return
+        async with db.connection(self.db_config) as conn:
+            yield conn
+
+    async def _ensure_table(self, conn: Optional[AsyncConnection] = None):
+        if self._table_ready:
+            return
+        async with self._connection(conn) as conn:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    model TEXT NOT NULL,
+                    dimensions INTEGER NOT NULL,
+                    precision TEXT NOT NULL,
+                    text_hash BYTEA NOT NULL,
+                    embedding BYTEA NOT NULL,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (model, dimensions, precision, text_hash)
+                );
+            """, prepare=False)
+        self._table_ready = True
+
+    @staticmethod
+    def text_hash(text: str, embed_type: str) -> bytes:
+        return hashlib.sha256(f"{embed_type}\x00{text}".encode()).digest()
+
+    def _remember(self, key: CacheKey, embedding: np.ndarray):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    async def get_many(
+        self,
+        model: str,
+        dimensions: int,
+        precision: str,
+        texts: List[str],
+        embed_type: str = "document",
+        memory_only: bool = False,
+        conn: Optional[AsyncConnection] = None
+    ) -> List[Optional[np.ndarray]]:
+        """Cached embeddings for texts in order, None for each miss.
+
+        Args:
+            memory_only: Only consult the in-memory LRU
+            conn: Connection to read through instead of a pooled one, e.g. one held for a bulk insert
+        """
+        keys = [(model, dimensions, precision, self.text_hash(text, embed_type)) for text in texts]
+        results: List[Optional[np.ndarray]] = [None] * len(keys)
+        with self._lock:
+            for idx, key in enumerate(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    results[idx] = self.memory[key]
+                    self.metrics["memory_hits"] += 1
+
+        missing: Dict[bytes, List[int]] = {}
+        for idx, key in enumerate(keys):
+            if results[idx] is None:
+                missing.setdefault(key[3], []).append(idx)
+        if not missing or memory_only:
+            return results
+
+        async with self._connection(conn) as conn:
+            await self._ensure_table(conn)
+            cur = await conn.execute(f"""
+                SELECT text_hash, embedding
+                FROM {self.table_name}
+                WHERE model = %s AND dimensions = %s AND precision = %s AND text_hash = ANY(%s);
+            """, (model, dimensions, precision, list(missing)))
+            rows = await cur.fetchall()
+
+        dtype = PRECISION_DTYPES[precision]
+        with self._lock:
+            for text_hash, embedding in rows:
+                embedding = np.frombuffer(bytes(embedding), dtype=dtype)
+                for idx in missing.pop(bytes(text_hash), []):
+                    results[idx] = embedding
+                    self.metrics["db_hits"] += 1
+                self._remember((model, dimensions, precision, bytes(text_hash)), embedding)
+            self.metrics["misses"] += sum(len(idxs) for idxs in missing.values())
+        return results
+
+    async def put_many(
+        self,
+        model: str,
+        dimensions: int,
+        precision: str,
+        texts: List[str],
+        embeddings: np.ndarray,
+        embed_type: str = "document",
+        conn: Optional[AsyncConnection] = None
+    ):
+        """Stores embeddings of texts, conn is written through instead of a pooled connection when given."""
+        dtype = PRECISION_DTYPES[precision]
+        rows = {}
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                embedding = np.ascontiguousarray(embedding, dtype=dtype)
+                text_hash = self.text_hash(text, embed_type)
+                self._remember((model, dimensions, precision, text_hash), embedding)
+                rows[text_hash] = (model, dimensions, precision, text_hash, embedding.tobytes())
+        if not rows:
+            return
+
+        async with self._connection(conn) as conn:
+            await self._ensure_table(conn)
+            async with conn.cursor() as cur:
+                await cur.executemany(f"""
+                    INSERT INTO {self.table_name} (model, dimensions, precision, text_hash, embedding)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT DO NOTHING;
+                """, list(rows.values()))
+        logger.debug("Embedding_cache_stored {count} {metrics}", count=len(rows), metrics=self.metrics)
+
+
+_caches: Dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+def get_embedding_cache(db_config: Dict[str, str]) -> EmbeddingCache:
+    """Process wide cache per database so every VectorSearch shares the in-memory LRU."""
+    dsn = db.make_dsn(db_config)
+    with _caches_lock:
+        if dsn not in _caches:
+            _caches[dsn] = EmbeddingCache(db_config)
+        return _caches[dsn]
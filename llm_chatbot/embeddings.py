@@ -0,0 +1,183 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Dict, List, Literal, Optional, Tuple, Union
+import numpy as np
+from loguru import logger
+from sentence_transformers import SentenceTransformer
+
+DEFAULT_EMBEDDING_MODEL = "mixedbread-ai/mxbai-embed-large-v1"
+QUERY_PROMPT = "Represent this sentence for searching relevant passages: "
+
+_lock = threading.Lock()
+_models: Dict[str, SentenceTransformer] = {}
+
+
+def get_embedding_model(model_name: str = DEFAULT_EMBEDDING_MODEL) -> SentenceTransformer:
+    """Process wide model instance, loaded on first use and shared by every VectorSearch."""
+    with _lock:
+        if model_name not in _models:
+            logger.info("Loading embedding model {model}", model=model_name)
+            # full dimension model, matryoshka truncation happens per call in encode()
+            _models[model_name] = SentenceTransformer(model_name)
+        return _models[model_name]
+
+
+def encode(
+    texts: Union[str, List[str]],
+    model_name: str = DEFAULT_EMBEDDING_MODEL,
+    dimensions: Optional[int] = None,
+    embed_type: Literal["query", "document"] = "document"
+) -> np.ndarray:
+    """Embed one text or a batch of texts with the shared model.
+
+    Args:
+        texts: A single text or a list of texts
+        model_name: Embedding model to use
+        dimensions: Keep only the first dimensions values of each embedding (MRL), None keeps all
+        embed_type: "query" adds the retrieval query prompt
+
+    Returns:
+        A (dim,) array for a single text, otherwise a (len(texts), dim) array
+    """
+    model = get_embedding_model(model_name)
+    single = isinstance(texts, str)
+    batch = [texts] if single else list(texts)
+
+    if embed_type == "query":
+        batch = [f"{QUERY_PROMPT}{text}" for text in batch]
+        embeddings = model.encode(batch, prompt_name="query", show_progress_bar=False)
+    else:
+        embeddings = model.encode(batch, show_progress_bar=False)
+
+    embeddings = np.asarray(embeddings)
+    if dimensions is not None:
+        embeddings = embeddings[:, :dimensions]
+    return embeddings[0] if single else embeddings
+
+
+@dataclass
+class _EncodeRequest:
+    text: str
+    model_name: str
+    dimensions: Optional[int]
+    embed_type: str
+    future: Future
+    enqueued_at: float
+
+
+class EmbeddingBatcher:
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        """Collects concurrent encode requests from every session into micro-batches.
+
+        A single worker thread takes the first waiting request, keeps collecting for up to max_wait_ms or
+        until max_batch_size requests are waiting, and encodes them with one model.encode call per
+        (model, embed_type). Callers can block on encode() from worker threads or await aencode() on the loop.
+
+        Args:
+            max_batch_size: Max texts per model.encode call
+            max_wait_ms: How long the first request of a batch waits for others to join
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = {
+            "requests": 0,
+            "batches": 0,
+            "max_batch_size": 0,
+            "avg_batch_size": 0.0,
+            "avg_queue_wait_ms": 0.0,
+            "avg_encode_ms": 0.0,
+        }
+        self._queue: "queue.Queue[_EncodeRequest]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding_batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str, model_name: str = DEFAULT_EMBEDDING_MODEL, dimensions: Optional[int] = None, embed_type: str = "document") -> Future:
+        future = Future()
+        self._queue.put(_EncodeRequest(text, model_name, dimensions, embed_type, future, time.monotonic()))
+        return future
+
+    def encode(
+        self,
+        texts: Union[str, List[str]],
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+        dimensions: Optional[int] = None,
+        embed_type: Literal["query", "document"] = "document"
+    ) -> np.ndarray:
+        """Blocking batched counterpart of the module level encode(), same arguments and return shape."""
+        if isinstance(texts, str):
+            return self.submit(texts, model_name, dimensions, embed_type).result()
+        futures = [self.submit(text, model_name, dimensions, embed_type) for text in texts]
+        return np.stack([future.result() for future in futures]) if futures else np.empty((0, dimensions or 0))
+
+    async def aencode(
+        self,
+        texts: Union[str, List[str]],
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+        dimensions: Optional[int] = None,
+        embed_type: Literal["query", "document"] = "document"
+    ) -> np.ndarray:
+        """Awaitable encode(), doesn't block the event loop while the batch is encoded."""
+        if isinstance(texts, str):
+            return await asyncio.wrap_future(self.submit(texts, model_name, dimensions, embed_type))
+        futures = [asyncio.wrap_future(self.submit(text, model_name, dimensions, embed_type)) for text in texts]
+        return np.stack(await asyncio.gather(*futures)) if futures else np.empty((0, dimensions or 0))
+
+    def _collect_batch(self) -> List[_EncodeRequest]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _record_batch(self, batch: List[_EncodeRequest], started_at: float, encode_seconds: float):
+        metrics = self.metrics
+        metrics["batches"] += 1
+        metrics["requests"] += len(batch)
+        metrics["max_batch_size"] = max(metrics["max_batch_size"], len(batch))
+        metrics["avg_batch_size"] = metrics["requests"] / metrics["batches"]
+        queue_wait_ms = sum(started_at - request.enqueued_at for request in batch) * 1000
+        metrics["avg_queue_wait_ms"] += (queue_wait_ms - len(batch) * metrics["avg_queue_wait_ms"]) / metrics["requests"]
+        metrics["avg_encode_ms"] += (encode_seconds * 1000 - metrics["avg_encode_ms"]) / metrics["batches"]
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            started_at = time.monotonic()
+
+            groups: Dict[Tuple[str, str], List[_EncodeRequest]] = {}
+            for request in batch:
+                groups.setdefault((request.model_name, request.embed_type), []).append(request)
+
+            for (model_name, embed_type), requests in groups.items():
+                try:
+                    # encode at full dimension once, each request gets its own MRL truncation
+                    embeddings = encode([request.text for request in requests], model_name=model_name, embed_type=embed_type)
+                except Exception as e:
+                    logger.error("Embedding batch failed {model} {size} {error}", model=model_name, size=len(requests), error=e)
+                    for request in requests:
+                        request.future.set_exception(e)
+                    continue
+                for request, embedding in zip(requests, embeddings):
+                    request.future.set_result(embedding[:request.dimensions] if request.dimensions is not None else embedding)
+
+            self._record_batch(batch, started_at, time.monotonic() - started_at)
+            logger.debug("Embedding_batch {size} {metrics}", size=len(batch), metrics=self.metrics)
+
+
+_batcher: Optional[EmbeddingBatcher] = None
+
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """Process wide batcher so encode requests from all sessions share batches."""
+    global _batcher
+    with _lock:
+        if _batcher is None:
+            _batcher = EmbeddingBatcher()
+        return _batcher
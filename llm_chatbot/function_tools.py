@@ -37,7 +37,7 @@ from PIL import Image
 import os
 import json
 from typing import Union, Dict
-import openai
+from llm_chatbot.llm_transport import get_openai_client
 
 @tool
 def open_image_file(filepath: str):
@@ -280,10 +280,7 @@ Your output should always be valid JSON in this format:
     "description": "<detailed yet concise description outlining/highlighting the tools functions>"
 }}]<|eot_id|><|start_header_id|>user<|end_header_id|>Below is a group of tool method sets:\n{tool_overview_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>[{{"tool_name":"'''
 
-    openai_client = openai.OpenAI(
-        api_key=OPENROUTER_API_KEY,
-        base_url="https://openrouter.ai/api/v1"
-    )
+    openai_client = get_openai_client("https://openrouter.ai/api/v1", OPENROUTER_API_KEY)
     prompt_completion = openai_client.completions.create(
         model="perplexity/llama-3.1-sonar-small-128k-chat",
         prompt=prompt,
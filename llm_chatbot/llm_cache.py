@@ -0,0 +1,151 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import numpy as np
+from loguru import logger
+
+
+class LLMResponseCache:
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        ttl_seconds: float = 6 * 60 * 60,
+        semantic_threshold: float = 0.95,
+        persist_path: Optional[str] = None
+    ):
+        """Exact-match and semantic cache for auxiliary LLM completions.
+
+        Entries are keyed on (model, messages, params). The semantic tier matches entries that share
+        everything but the last message, comparing an embedding of that last message.
+
+        Args:
+            max_entries: LRU capacity
+            ttl_seconds: Entries older than this are treated as missing
+            semantic_threshold: Min cosine similarity for a semantic hit
+            persist_path: JSON file the cache is loaded from and saved to, None keeps it in memory only
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.semantic_threshold = semantic_threshold
+        self.persist_path = persist_path
+        self.entries: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self.metrics = {"hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+        if self.persist_path is not None:
+            self.load()
+
+    @staticmethod
+    def _hash(value: Any) -> str:
+        return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+    def make_key(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> str:
+        return self._hash({"model": model, "messages": messages, "params": params})
+
+    def make_scope(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> str:
+        """Everything but the last message, semantic matches are only looked up within a scope."""
+        return self._hash({"model": model, "messages": messages[:-1], "params": params})
+
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["created_at"] > self.ttl_seconds
+
+    def lookup(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any], embedding: Optional[np.ndarray] = None) -> Optional[Dict[str, Any]]:
+        """Returns the cached completion dict, trying the exact key first and then the semantic tier if embedding is given."""
+        key = self.make_key(model, messages, params)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry):
+                del self.entries[key]
+                self.metrics["expired"] += 1
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.metrics["hits"] += 1
+                return entry["completion"]
+
+            if embedding is not None:
+                scope = self.make_scope(model, messages, params)
+                best_key, best_similarity = None, self.semantic_threshold
+                query = embedding / (np.linalg.norm(embedding) + 1e-12)
+                for entry_key, entry in self.entries.items():
+                    if entry["scope"] != scope or entry["embedding"] is None or self._expired(entry):
+                        continue
+                    similarity = float(np.dot(query, entry["embedding"]))
+                    if similarity >= best_similarity:
+                        best_key, best_similarity = entry_key, similarity
+                if best_key is not None:
+                    self.entries.move_to_end(best_key)
+                    self.metrics["semantic_hits"] += 1
+                    logger.debug("LLM_cache_semantic_hit {similarity}", similarity=best_similarity)
+                    return self.entries[best_key]["completion"]
+
+            self.metrics["misses"] += 1
+            return None
+
+    def store(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any], completion: Dict[str, Any], embedding: Optional[np.ndarray] = None):
+        key = self.make_key(model, messages, params)
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            embedding = embedding / (np.linalg.norm(embedding) + 1e-12)
+        with self._lock:
+            self.entries[key] = {
+                "created_at": time.time(),
+                "scope": self.make_scope(model, messages, params),
+                "embedding": embedding,
+                "completion": completion,
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+    def save(self):
+        if self.persist_path is None:
+            return
+        with self._lock:
+            entries = [
+                dict(entry, key=key, embedding=entry["embedding"].tolist() if entry["embedding"] is not None else None)
+                for key, entry in self.entries.items()
+                if not self._expired(entry)
+            ]
+        tmp_path = f"{self.persist_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.persist_path)
+        logger.info("Saved {count} llm cache entries to {path}", count=len(entries), path=self.persist_path)
+
+    def load(self):
+        if self.persist_path is None or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path) as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error("failed to load llm cache from {path}: {error}", path=self.persist_path, error=e)
+            return
+        with self._lock:
+            for entry in entries:
+                key = entry.pop("key")
+                if entry["embedding"] is not None:
+                    entry["embedding"] = np.asarray(entry["embedding"], dtype=np.float32)
+                if not self._expired(entry):
+                    self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        logger.info("Loaded {count} llm cache entries from {path}", count=len(self.entries), path=self.persist_path)
+
+
+_response_cache: Optional[LLMResponseCache] = None
+
+def get_response_cache() -> LLMResponseCache:
+    """Process wide cache, persisted to LLM_RESPONSE_CACHE_PATH and saved again at exit."""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = LLMResponseCache(persist_path=os.getenv("LLM_RESPONSE_CACHE_PATH", "llm_response_cache.json"))
+        atexit.register(_response_cache.save)
+    return _response_cache
@@ -0,0 +1,41 @@
+import json
+import os
+import random
+from typing import Dict, Literal, Optional
+from pydantic import BaseModel, Field
+
+DEFAULT_PROFILES_PATH = os.path.join(os.path.dirname(__file__), "llm_profiles.json")
+
+
+class LLMCallProfile(BaseModel):
+    provider: Literal["pool", "fireworks"] = "pool"
+    model: Optional[str] = Field(default=None, description="Model to call, None uses the session's model")
+    max_tokens: int = 4096
+    temperature: float = 0.1
+    timeout: float = Field(default=60.0, description="Deadline in seconds for a single attempt")
+    retries: int = Field(default=2, description="Extra attempts after the first one fails")
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    fallback_model: Optional[str] = Field(default=None, description="Tried once after all attempts on model failed")
+    cache: Optional[Literal["exact", "semantic"]] = None
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Full jitter exponential backoff for the given 0-based attempt."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+def load_profiles(path: Optional[str] = None) -> Dict[str, LLMCallProfile]:
+    """Load call profiles from path, LLM_PROFILES_PATH or the bundled llm_profiles.json."""
+    path = path or os.getenv("LLM_PROFILES_PATH", DEFAULT_PROFILES_PATH)
+    with open(path) as f:
+        profiles = json.load(f)
+    return {name: LLMCallProfile(**profile) for name, profile in profiles.items()}
+
+
+_profiles: Optional[Dict[str, LLMCallProfile]] = None
+
+def get_llm_profiles() -> Dict[str, LLMCallProfile]:
+    global _profiles
+    if _profiles is None:
+        _profiles = load_profiles()
+    return _profiles
@@ -0,0 +1,265 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import openai
+from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from loguru import logger
+
+from llm_chatbot.llm_transport import get_async_openai_client
+from secret_keys import OPENROUTER_API_KEY, TOGETHER_AI_TOKEN
+
+
+@dataclass
+class LLMProvider:
+    name: str
+    base_url: str
+    api_key: str
+    # canonical (openrouter style) model name -> this provider's model id
+    model_map: Dict[str, str] = field(default_factory=dict)
+    serves_all_models: bool = False
+    extra_body: Optional[dict] = None
+
+    def __post_init__(self):
+        self.client = get_async_openai_client(self.base_url, self.api_key)
+
+    def serves(self, model: str) -> bool:
+        return self.serves_all_models or model in self.model_map
+
+    def model_id(self, model: str) -> str:
+        return self.model_map.get(model, model)
+
+
+class EndpointStats:
+    """Health and latency of one (provider, model) endpoint."""
+
+    def __init__(self, ewma_alpha: float = 0.2, window: int = 100):
+        self.ewma_alpha = ewma_alpha
+        self.ewma_ttft: Optional[float] = None
+        self.ewma_total: Optional[float] = None
+        self.recent_totals = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def _ewma(self, current: Optional[float], value: float) -> float:
+        return value if current is None else self.ewma_alpha * value + (1 - self.ewma_alpha) * current
+
+    def record_success(self, total: float, ttft: Optional[float] = None):
+        self.ewma_total = self._ewma(self.ewma_total, total)
+        if ttft is not None:
+            self.ewma_ttft = self._ewma(self.ewma_ttft, ttft)
+        self.recent_totals.append(total)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def record_failure(self, failure_threshold: int, cooldown_seconds: float):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= failure_threshold:
+            self.unhealthy_until = time.monotonic() + cooldown_seconds
+
+    def mark_unavailable(self, cooldown_seconds: float):
+        self.unhealthy_until = time.monotonic() + cooldown_seconds
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def p95_total(self, min_samples: int = 20) -> Optional[float]:
+        if len(self.recent_totals) < min_samples:
+            return None
+        totals = sorted(self.recent_totals)
+        return totals[int(0.95 * (len(totals) - 1))]
+
+    def to_dict(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "ewma_ttft": self.ewma_ttft,
+            "ewma_total": self.ewma_total,
+            "p95_total": self.p95_total(),
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class ProviderPool:
+    def __init__(
+        self,
+        providers: List[LLMProvider],
+        failure_threshold: int = 3,
+        cooldown_seconds: float = 60.0,
+        model_unavailable_cooldown_seconds: float = 3600.0,
+        hedge_requests: bool = False,
+        hedge_min_delay: float = 1.0
+    ):
+        """Routes each model to the fastest healthy provider endpoint that serves it.
+
+        Args:
+            providers: Providers in order of preference, used to break ties between endpoints with no latency data
+            failure_threshold: Consecutive failures after which an endpoint is benched
+            cooldown_seconds: How long a failing endpoint is benched
+            model_unavailable_cooldown_seconds: How long an endpoint is benched when the provider stopped serving the model
+            hedge_requests: Send a second request to the next endpoint when the first is slower than its p95
+            hedge_min_delay: Lower bound for the hedge delay in seconds
+        """
+        self.providers = providers
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.model_unavailable_cooldown_seconds = model_unavailable_cooldown_seconds
+        self.hedge_requests = hedge_requests
+        self.hedge_min_delay = hedge_min_delay
+        self.stats: Dict[Tuple[str, str], EndpointStats] = {}
+
+    @property
+    def primary(self) -> LLMProvider:
+        return self.providers[0]
+
+    def _stats(self, provider: LLMProvider, model: str) -> EndpointStats:
+        key = (provider.name, model)
+        if key not in self.stats:
+            self.stats[key] = EndpointStats()
+        return self.stats[key]
+
+    def route(self, model: str) -> List[LLMProvider]:
+        """
+        Providers serving model, healthy ones first and then by EWMA total latency. Endpoints without latency
+        data sort first so they get measured once.
+        """
+        candidates = [(idx, provider) for idx, provider in enumerate(self.providers) if provider.serves(model)]
+        if len(candidates) == 0:
+            raise ValueError(f"no provider serves model {model}")
+
+        def sort_key(candidate):
+            idx, provider = candidate
+            stats = self._stats(provider, model)
+            return (not stats.healthy, stats.ewma_total if stats.ewma_total is not None else 0.0, idx)
+        return [provider for _, provider in sorted(candidates, key=sort_key)]
+
+    def _record_failure(self, provider: LLMProvider, model: str, error: Exception):
+        stats = self._stats(provider, model)
+        if isinstance(error, openai.NotFoundError) or "model_not_available" in str(error):
+            logger.error("model not available on provider {provider}: {model}", provider=provider.name, model=model)
+            stats.mark_unavailable(self.model_unavailable_cooldown_seconds)
+        else:
+            stats.record_failure(self.failure_threshold, self.cooldown_seconds)
+        logger.warning("llm provider request failed {provider} {model} {error}", provider=provider.name, model=model, error=error)
+
+    def _request_kwargs(self, provider: LLMProvider, model: str, kwargs: dict) -> dict:
+        request_kwargs = dict(kwargs, model=provider.model_id(model))
+        if request_kwargs.get("extra_body") is None:
+            request_kwargs["extra_body"] = provider.extra_body
+        return request_kwargs
+
+    async def _timed_completion(self, provider: LLMProvider, model: str, kwargs: dict) -> ChatCompletion:
+        start = time.monotonic()
+        try:
+            completion = await provider.client.chat.completions.create(**self._request_kwargs(provider, model, kwargs))
+        except Exception as e:
+            self._record_failure(provider, model, e)
+            raise
+        self._stats(provider, model).record_success(time.monotonic() - start)
+        return completion
+
+    async def _hedged_completion(self, primary: LLMProvider, backup: LLMProvider, model: str, kwargs: dict) -> ChatCompletion:
+        """Waits p95 of the primary endpoint, then races a second request on backup and keeps the first success."""
+        hedge_delay = max(self._stats(primary, model).p95_total(), self.hedge_min_delay)
+        primary_task = asyncio.create_task(self._timed_completion(primary, model, kwargs))
+        done, _ = await asyncio.wait({primary_task}, timeout=hedge_delay)
+        if done:
+            return primary_task.result()
+
+        logger.info("hedging llm request {model} {primary} {backup} {delay}", model=model, primary=primary.name, backup=backup.name, delay=hedge_delay)
+        pending = {primary_task, asyncio.create_task(self._timed_completion(backup, model, kwargs))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def chat_completion(self, model: str, **kwargs) -> ChatCompletion:
+        """chat.completions.create on the best endpoint for model, failing over to the next one on errors."""
+        candidates = self.route(model)
+        error = None
+        for idx, provider in enumerate(candidates):
+            backup = candidates[idx + 1] if idx + 1 < len(candidates) else None
+            try:
+                if self.hedge_requests and backup is not None and self._stats(provider, model).p95_total() is not None:
+                    return await self._hedged_completion(provider, backup, model, kwargs)
+                return await self._timed_completion(provider, model, kwargs)
+            except Exception as e:
+                error = e
+        raise error
+
+    async def stream_chat_completion(self, model: str, **kwargs) -> AsyncIterator[ChatCompletionChunk]:
+        """
+        Streaming chat.completions.create with failover. Once the first chunk has been yielded the stream is
+        committed to that endpoint, so later errors are raised instead of retried.
+        """
+        error = None
+        for provider in self.route(model):
+            stats = self._stats(provider, model)
+            start = time.monotonic()
+            ttft = None
+            try:
+                stream = await provider.client.chat.completions.create(**self._request_kwargs(provider, model, dict(kwargs, stream=True)))
+                async for chunk in stream:
+                    if ttft is None:
+                        ttft = time.monotonic() - start
+                    yield chunk
+            except Exception as e:
+                self._record_failure(provider, model, e)
+                if ttft is not None:
+                    raise
+                error = e
+                continue
+            stats.record_success(time.monotonic() - start, ttft=ttft)
+            return
+        raise error
+
+    def health(self) -> Dict[str, dict]:
+        return {f"{provider}/{model}": stats.to_dict() for (provider, model), stats in self.stats.items()}
+
+
+def default_providers() -> List[LLMProvider]:
+    return [
+        LLMProvider(
+            name="openrouter",
+            base_url="https://openrouter.ai/api/v1",
+            api_key=OPENROUTER_API_KEY,
+            serves_all_models=True,
+            extra_body=None,
+            # {"provider": {
+            #         "order": [
+            #             "Together"
+            #         ]
+            #     }
+            # }
+        ),
+        LLMProvider(
+            name="together",
+            base_url="https://api.together.xyz/v1",
+            api_key=TOGETHER_AI_TOKEN,
+            model_map={
+                "meta-llama/llama-3.1-8b-instruct": "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
+                "meta-llama/llama-3.1-70b-instruct": "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
+                "qwen/qwen-2.5-72b-instruct": "Qwen/Qwen2.5-72B-Instruct-Turbo",
+            },
+        ),
+    ]
+
+
+_provider_pool: Optional[ProviderPool] = None
+
+def get_provider_pool() -> ProviderPool:
+    """Process wide pool so endpoint health and latency are learned across all sessions."""
+    global _provider_pool
+    if _provider_pool is None:
+        _provider_pool = ProviderPool(default_providers())
+    return _provider_pool
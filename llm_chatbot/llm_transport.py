@@ -0,0 +1,74 @@
+import threading
+from typing import Dict, Tuple
+import httpx
+import openai
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# limits are per host because every host gets its own pooled client
+MAX_CONNECTIONS_PER_HOST = 20
+MAX_KEEPALIVE_CONNECTIONS_PER_HOST = 10
+KEEPALIVE_EXPIRY_SECONDS = 120.0
+TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+# the SDK's own retries would multiply with the call profile retries and the provider pool failover
+OPENAI_MAX_RETRIES = 0
+
+_lock = threading.Lock()
+_async_http_clients: Dict[str, httpx.AsyncClient] = {}
+_http_clients: Dict[str, httpx.Client] = {}
+_async_openai_clients: Dict[Tuple[str, str], openai.AsyncOpenAI] = {}
+_openai_clients: Dict[Tuple[str, str], openai.OpenAI] = {}
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS_PER_HOST,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS_PER_HOST,
+        keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+    )
+
+def get_async_http_client(url: str) -> httpx.AsyncClient:
+    """Process wide pooled keep-alive client for the host of url, HTTP/2 when h2 is installed."""
+    host = httpx.URL(url).host
+    with _lock:
+        if host not in _async_http_clients:
+            _async_http_clients[host] = httpx.AsyncClient(limits=_limits(), timeout=TIMEOUT, http2=HTTP2_AVAILABLE)
+        return _async_http_clients[host]
+
+def get_http_client(url: str) -> httpx.Client:
+    """Sync counterpart of get_async_http_client for helpers that run outside the event loop."""
+    host = httpx.URL(url).host
+    with _lock:
+        if host not in _http_clients:
+            _http_clients[host] = httpx.Client(limits=_limits(), timeout=TIMEOUT, http2=HTTP2_AVAILABLE)
+        return _http_clients[host]
+
+def get_async_openai_client(base_url: str, api_key: str) -> openai.AsyncOpenAI:
+    key = (base_url, api_key)
+    if key not in _async_openai_clients:
+        _async_openai_clients[key] = openai.AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=get_async_http_client(base_url), max_retries=OPENAI_MAX_RETRIES)
+    return _async_openai_clients[key]
+
+def get_openai_client(base_url: str, api_key: str) -> openai.OpenAI:
+    key = (base_url, api_key)
+    if key not in _openai_clients:
+        _openai_clients[key] = openai.OpenAI(base_url=base_url, api_key=api_key, http_client=get_http_client(base_url), max_retries=OPENAI_MAX_RETRIES)
+    return _openai_clients[key]
+
+async def aclose():
+    """Close every pooled connection, call on process shutdown."""
+    with _lock:
+        async_clients = list(_async_http_clients.values())
+        sync_clients = list(_http_clients.values())
+        _async_http_clients.clear()
+        _http_clients.clear()
+        _async_openai_clients.clear()
+        _openai_clients.clear()
+    for client in async_clients:
+        await client.aclose()
+    for client in sync_clients:
+        client.close()
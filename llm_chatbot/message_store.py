@@ -0,0 +1,105 @@
+import datetime
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional
+
+
+class Message:
+    __slots__ = ("role", "content", "id", "token_count", "created_at")
+
+    def __init__(self, role: str, content: str, id: Optional[int] = None, token_count: int = 0, created_at: Optional[datetime.datetime] = None):
+        """One chat message with its chat_messages id and cached token count.
+
+        Args:
+            role: OpenAI chat role
+            content: Message text
+            id: chat_messages id, None for messages that aren't persisted as a row
+            token_count: Tokens of the message, counted once when it is added
+            created_at: When the message was added
+        """
+        self.role = role
+        self.content = content
+        self.id = id
+        self.token_count = token_count
+        self.created_at = created_at
+
+    def to_dict(self) -> Dict[str, str]:
+        """OpenAI chat message format."""
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self) -> str:
+        return f"Message(id={self.id}, role={self.role!r}, token_count={self.token_count}, content={self.content!r})"
+
+
+class MessageWindow:
+    def __init__(self, system: Optional[Message] = None):
+        """The messages of a session that are sent to the LLM.
+
+        The system message is pinned in front and never evicted, the rest is a deque so appending and evicting
+        the oldest message are O(1) and the token total is kept up to date as a running sum. The OpenAI message
+        list is only built by render() right before a completion call.
+
+        Args:
+            system: Pinned system message
+        """
+        self.system: Optional[Message] = None
+        self._messages: Deque[Message] = deque()
+        self.total_tokens = 0
+        if system is not None:
+            self.pin(system)
+
+    def pin(self, system: Message):
+        """Pin system as the system message, replacing the previous one."""
+        if self.system is not None:
+            self.total_tokens -= self.system.token_count
+        self.system = system
+        self.total_tokens += system.token_count
+
+    def append(self, message: Message):
+        self._messages.append(message)
+        self.total_tokens += message.token_count
+
+    def popleft(self) -> Message:
+        """Evict and return the oldest message after the pinned system message."""
+        message = self._messages.popleft()
+        self.total_tokens -= message.token_count
+        return message
+
+    def clear(self):
+        """Drop every message except the pinned system message."""
+        self._messages.clear()
+        self.total_tokens = self.system.token_count if self.system is not None else 0
+
+    def tail(self, count: int) -> List[Message]:
+        """The last count messages, oldest first, including the system message only if fewer messages exist."""
+        if count <= 0:
+            return []
+        messages = [self._messages[-idx] for idx in range(min(count, len(self._messages)), 0, -1)]
+        if len(messages) < count and self.system is not None:
+            messages.insert(0, self.system)
+        return messages
+
+    def render(self) -> List[Dict[str, str]]:
+        return [message.to_dict() for message in self]
+
+    def __iter__(self) -> Iterator[Message]:
+        if self.system is not None:
+            yield self.system
+        yield from self._messages
+
+    def __repr__(self) -> str:
+        return f"MessageWindow(total_tokens={self.total_tokens}, messages={list(self)!r})"
+
+    def __len__(self) -> int:
+        return len(self._messages) + (self.system is not None)
+
+    def __getitem__(self, idx: int) -> Message:
+        """Message by position with the system message at 0, O(1) for positions near either end."""
+        if idx < 0:
+            idx += len(self)
+        if self.system is not None:
+            if idx == 0:
+                return self.system
+            idx -= 1
+        if idx < 0:
+            raise IndexError("message index out of range")
+        return self._messages[idx]
@@ -0,0 +1,313 @@
+import asyncio
+import datetime
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from loguru import logger
+from psycopg import OperationalError
+from psycopg.types.json import Jsonb
+
+from llm_chatbot import db
+from llm_chatbot.rag_db import VectorSearch
+
+
+class MessageWriter:
+    def __init__(
+        self,
+        db_config: Dict[str, str],
+        flush_interval: float = 0.5,
+        max_pending: int = 256,
+        id_block_size: int = 64,
+        max_attempts: int = 3,
+        max_queued: int = 10000
+    ):
+        """Write-behind persistence for chat messages, function calls, purge marks and conversation RAG rows.
+
+        Messages get their chat_messages id immediately from a block of sequence values reserved ahead of time,
+        and are queued. A background task writes everything queued in one transaction when a turn ends
+        (flush_soon()), every flush_interval seconds, or once max_pending rows are waiting. The RAG rows are
+        embedded and inserted after that commit, so the agent loop never waits on a commit or an embedding.
+        close() flushes what is left on shutdown.
+
+        A failed batch is requeued and retried. Once it failed max_attempts times in a row, or right away when
+        the error isn't a connection problem, its rows are written one per transaction and the rows that still
+        fail are logged as Message_writer_dead_letter and dropped, so one bad row can't stall every session.
+
+        Args:
+            db_config: PostgreSQL connection parameters
+            flush_interval: Max seconds a queued row waits before it is written
+            max_pending: Queued rows that trigger a flush before the interval is up
+            id_block_size: chat_messages ids reserved per sequence round trip
+            max_attempts: Failed flushes of a batch before it is written row by row
+            max_queued: Queued rows kept while the database is unreachable, the oldest are dead lettered beyond it
+        """
+        self.db_config = db_config
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.id_block_size = id_block_size
+        self.max_attempts = max_attempts
+        self.max_queued = max_queued
+        self.metrics = {"flushes": 0, "messages": 0, "function_calls": 0, "purged": 0, "rag_rows": 0, "failed_flushes": 0, "dead_lettered": 0, "avg_flush_ms": 0.0}
+        self._failed_attempts = 0
+
+        # (id, chat_id, role, content, token_count, created_at)
+        self._messages: List[tuple] = []
+        # (chat_id, function_name, parameters, response)
+        self._function_calls: List[tuple] = []
+        # chat_messages ids to mark as purged, written after the inserts so queued messages are covered
+        self._purged_ids: List[int] = []
+        # (vector_search, content, chat_id)
+        self._rag_rows: List[Tuple[VectorSearch, str, str]] = []
+        self._ids: Deque[int] = deque()
+        self._id_refill: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._rag_inserts: Set[asyncio.Future] = set()
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._flush_lock = self._flush_lock or asyncio.Lock()
+            self._wakeup = self._wakeup or asyncio.Event()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _reserve_ids(self):
+        rows = await db.fetchall(self.db_config, """
+            SELECT nextval(pg_get_serial_sequence('chat_messages', 'id'))
+            FROM generate_series(1, %s)
+        """, (self.id_block_size,))
+        self._ids.extend(row[0] for row in rows)
+
+    async def next_id(self) -> int:
+        """Next chat_messages id, the following block is reserved in the background before this one runs out."""
+        if len(self._ids) <= self.id_block_size // 2 and (self._id_refill is None or self._id_refill.done()):
+            self._id_refill = asyncio.create_task(self._reserve_ids())
+        while not self._ids:
+            await asyncio.shield(self._id_refill)
+            if not self._ids:
+                self._id_refill = asyncio.create_task(self._reserve_ids())
+        return self._ids.popleft()
+
+    async def add_message(
+        self,
+        chat_id: str,
+        role: str,
+        content: str,
+        token_count: int,
+        created_at: datetime.datetime,
+        rag: Optional[Tuple[VectorSearch, str]] = None
+    ) -> int:
+        """Queue a chat_messages row and return its id.
+
+        Args:
+            created_at: Timestamp stored with the message, set by the caller so it matches its RAG text
+            rag: (index, text) to embed and insert into a conversation RAG index once the message is written
+        """
+        self._ensure_worker()
+        message_id = await self.next_id()
+        self._messages.append((message_id, chat_id, role, content, token_count, created_at))
+        if rag is not None:
+            self._rag_rows.append((rag[0], rag[1], chat_id))
+        self._wake_if_full()
+        return message_id
+
+    def add_function_call(self, chat_id: str, function_name: str, parameters: Any, response: str):
+        """Queue a function_calls row."""
+        self._ensure_worker()
+        self._function_calls.append((chat_id, function_name, Jsonb(parameters), response))
+        self._wake_if_full()
+
+    def mark_purged(self, message_ids: List[int]):
+        """Queue chat_messages ids that were purged from a session's context window."""
+        self._ensure_worker()
+        self._purged_ids.extend(message_ids)
+
+    def _wake_if_full(self):
+        if len(self._messages) + len(self._function_calls) >= self.max_pending:
+            self._wakeup.set()
+
+    def flush_soon(self):
+        """Ask the background task to write the queue now, e.g. at the end of a turn, without waiting for it."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # rows stay queued and are retried on the next wakeup
+                logger.error("Message_writer_flush_failed {error}", error=e)
+
+    async def flush(self):
+        """Write everything queued so far: messages and function calls in one transaction, then start the RAG inserts."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            messages, self._messages = self._messages, []
+            function_calls, self._function_calls = self._function_calls, []
+            purged_ids, self._purged_ids = self._purged_ids, []
+            rag_rows, self._rag_rows = self._rag_rows, []
+            if not (messages or function_calls or purged_ids or rag_rows):
+                return
+
+            started_at = time.perf_counter()
+            try:
+                await self._write(messages, function_calls, purged_ids)
+            except Exception as e:
+                self.metrics["failed_flushes"] += 1
+                self._failed_attempts += 1
+                if isinstance(e, OperationalError) and self._failed_attempts < self.max_attempts:
+                    self._requeue(messages, function_calls, purged_ids, rag_rows)
+                    raise
+                logger.warning("Message_writer_splitting_batch {attempts} {error}", attempts=self._failed_attempts, error=e)
+                await self._write_row_by_row(messages, function_calls, purged_ids, rag_rows)
+            self._failed_attempts = 0
+
+            metrics = self.metrics
+            metrics["flushes"] += 1
+            metrics["messages"] += len(messages)
+            metrics["function_calls"] += len(function_calls)
+            metrics["purged"] += len(purged_ids)
+            metrics["avg_flush_ms"] += ((time.perf_counter() - started_at) * 1000 - metrics["avg_flush_ms"]) / metrics["flushes"]
+            logger.debug("Message_writer_flushed {messages} {function_calls} {rag_rows} {metrics}", messages=len(messages), function_calls=len(function_calls), rag_rows=len(rag_rows), metrics=metrics)
+
+        # the messages are durable at this point. The RAG rows are embedded and inserted in a task that isn't
+        # awaited, so neither a caller waiting for its messages (e.g. a session load) nor the background worker
+        # waits on embeddings. close() waits for the inserts still running
+        if rag_rows:
+            rag_insert = asyncio.ensure_future(self._insert_rag_rows(rag_rows))
+            self._rag_inserts.add(rag_insert)
+            rag_insert.add_done_callback(self._rag_inserts.discard)
+
+    async def _write(self, messages: List[tuple], function_calls: List[tuple], purged_ids: List[int]):
+        if not (messages or function_calls or purged_ids):
+            return
+        async with db.connection(self.db_config) as conn:
+            async with conn.cursor() as cur:
+                if messages:
+                    await cur.executemany("""
+                        INSERT INTO chat_messages (id, chat_id, role, content, token_count, created_at)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                    """, messages)
+                if function_calls:
+                    await cur.executemany("""
+                        INSERT INTO function_calls (chat_id, function_name, parameters, response)
+                        VALUES (%s, %s, %s, %s)
+                    """, function_calls)
+                if purged_ids:
+                    # the session's purge totals move in the same transaction, rows already purged aren't counted twice
+                    await cur.execute("""
+                        WITH purged AS (
+                            UPDATE chat_messages
+                            SET is_purged = TRUE
+                            WHERE id = ANY(%s) AND NOT is_purged
+                            RETURNING chat_id, token_count
+                        )
+                        UPDATE chat_sessions s
+                        SET purged_message_count = s.purged_message_count + p.message_count,
+                            purged_token_count = s.purged_token_count + p.token_count
+                        FROM (
+                            SELECT chat_id, count(*) AS message_count, sum(token_count) AS token_count
+                            FROM purged
+                            GROUP BY chat_id
+                        ) p
+                        WHERE s.chat_id = p.chat_id
+                    """, (purged_ids,))
+
+    async def _write_row_by_row(self, messages: List[tuple], function_calls: List[tuple], purged_ids: List[int], rag_rows: List[tuple]):
+        """
+        Writes each row in its own transaction and dead letters the ones that fail. A connection error means
+        the database, not the row, is the problem, so the unwritten rest is requeued and the error raised.
+        """
+        # purge marks go last so they cover the messages written before them
+        rows = [("message", row) for row in messages] + [("function_call", row) for row in function_calls]
+        if purged_ids:
+            rows.append(("purged_ids", purged_ids))
+        for idx, (kind, row) in enumerate(rows):
+            try:
+                await self._write(
+                    [row] if kind == "message" else [],
+                    [row] if kind == "function_call" else [],
+                    row if kind == "purged_ids" else []
+                )
+            except OperationalError:
+                rest = rows[idx:]
+                self._requeue(
+                    [row for kind, row in rest if kind == "message"],
+                    [row for kind, row in rest if kind == "function_call"],
+                    next((row for kind, row in rest if kind == "purged_ids"), []),
+                    rag_rows
+                )
+                raise
+            except Exception as e:
+                self._dead_letter(kind, row, e)
+
+    def _requeue(self, messages: List[tuple], function_calls: List[tuple], purged_ids: List[int], rag_rows: List[tuple]):
+        """Puts unwritten rows back in front of the queue, dropping the oldest beyond max_queued."""
+        self._messages[:0] = messages
+        self._function_calls[:0] = function_calls
+        self._purged_ids[:0] = purged_ids
+        self._rag_rows[:0] = rag_rows
+        overflow = len(self._messages) + len(self._function_calls) - self.max_queued
+        if overflow > 0:
+            dropped_messages, self._messages = self._messages[:overflow], self._messages[overflow:]
+            overflow -= len(dropped_messages)
+            dropped_function_calls, self._function_calls = self._function_calls[:overflow], self._function_calls[overflow:]
+            for row in dropped_messages:
+                self._dead_letter("message", row, "queue full")
+            for row in dropped_function_calls:
+                self._dead_letter("function_call", row, "queue full")
+
+    def _dead_letter(self, kind: str, row: Any, error: Any):
+        self.metrics["dead_lettered"] += 1
+        logger.error("Message_writer_dead_letter {kind} {row} {error}", kind=kind, row=row, error=error)
+
+    async def _insert_rag_rows(self, rag_rows: List[Tuple[VectorSearch, str, str]]):
+        """Embeds and inserts conversation RAG rows, grouped per index. A failed embedding only costs its rows."""
+        indexes: Dict[int, Tuple[VectorSearch, List[Tuple[str, None]], List[str]]] = {}
+        for vector_search, content, chat_id in rag_rows:
+            _, items, chat_ids = indexes.setdefault(id(vector_search), (vector_search, [], []))
+            items.append((content, None))
+            chat_ids.append(chat_id)
+        for vector_search, items, chat_ids in indexes.values():
+            try:
+                await vector_search.insert_many(items, chat_ids=chat_ids)
+                self.metrics["rag_rows"] += len(items)
+            except Exception as e:
+                logger.error("Message_writer_rag_insert_failed {table} {count} {error}", table=vector_search.table_name, count=len(items), error=e)
+
+    async def close(self):
+        """Stop the background task and write whatever is still queued."""
+        if self._worker is not None:
+            # cancel between flushes so a batch that is being written isn't dropped halfway
+            async with self._flush_lock:
+                self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.flush()
+        await asyncio.gather(*self._rag_inserts)
+
+
+_writers: Dict[str, MessageWriter] = {}
+
+def get_message_writer(db_config: Dict[str, str]) -> MessageWriter:
+    """Process wide writer per database so the writes of every session share batches."""
+    dsn = db.make_dsn(db_config)
+    if dsn not in _writers:
+        _writers[dsn] = MessageWriter(db_config)
+    return _writers[dsn]
+
+
+async def close_message_writers():
+    """Flush and stop every writer, call on process shutdown before db.close_pools()."""
+    for writer in list(_writers.values()):
+        await writer.close()
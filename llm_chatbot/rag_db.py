@@ -1,97 +1,323 @@
+import asyncio
 import json
-from typing import List, Dict, Any, Tuple
+import struct
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, AsyncIterator, Literal, Optional, Tuple
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sentence_transformers.quantization import quantize_embeddings
-import psycopg2
-from psycopg2.extras import execute_values, Json
-import torch
+from loguru import logger
+from psycopg import AsyncConnection
+from psycopg.types.json import Jsonb
 import os
 
+from llm_chatbot import db
+from llm_chatbot.embeddings import DEFAULT_EMBEDDING_MODEL, get_embedding_batcher, get_embedding_model
+from llm_chatbot.embedding_cache import get_embedding_cache
+
+# tables whose schema was already ensured by this process, so sessions don't run DDL on start
+_initialized_tables = set()
+_init_locks: Dict[str, asyncio.Lock] = {}
+# installed pgvector version per database, read once when a schema is ensured
+_pgvector_versions: Dict[str, Tuple[int, ...]] = {}
+# iterative index scans (hnsw/ivfflat.iterative_scan) only exist from this pgvector version on
+ITERATIVE_SCAN_VERSION = (0, 8, 0)
+# without iterative scans a scoped query widens the single index pass by this factor instead
+SCOPED_OVERFETCH = 10
+# pgvector's upper bound for hnsw.ef_search
+MAX_HNSW_EF_SEARCH = 1000
+
 class VectorSearch:
     def __init__(
         self,
         db_config: dict[str, str],
         dimensions: int = 512,
-        model_name: str = "mixedbread-ai/mxbai-embed-large-v1",
-        use_binary: bool = True,
-        table_name: str = "embeddings" 
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+        use_binary: Optional[bool] = None,
+        table_name: str = "embeddings",
+        precision: Literal["float32", "halfvec", "int8", "binary"] = "float32",
+        rescore_multiplier: int = 4,
+        funnel_dims: Optional[List[int]] = None,
+        index_type: Literal["ivfflat", "hnsw"] = "ivfflat",
+        ivfflat_lists: int = 100,
+        ivfflat_probes: int = 10,
+        hnsw_m: int = 16,
+        hnsw_ef_construction: int = 64,
+        hnsw_ef_search: int = 40,
+        use_embedding_cache: bool = True,
+        user_id: Optional[str] = None,
+        chat_id: Optional[str] = None
     ):
         """Initialize the vector search system.
+
+        All database access goes through the process wide async pool (see llm_chatbot.db), the schema is
+        ensured on first use.
         
         Args:
+            db_config: PostgreSQL connection parameters
             dimensions: Number of dimensions to use (MRL)
             model_name: Name of the embedding model to use
-            connection_string: PostgreSQL connection string
-            use_binary: Whether to use binary quantization
+            use_binary: Deprecated alias for precision="binary"
+            precision: How embeddings are stored, fixed when the table is created.
+                float32: vector column, exact cosine search
+                halfvec: half precision vector column, 2x smaller, cosine search
+                binary: sign bits in a bit column (32x smaller index), hamming distance candidates rescored
+                    against a halfvec column in SQL
+                int8: sign bits for hamming candidates, int8 scalar quantized vectors (4x smaller) in a bytea
+                    column that narrow them down in numpy, and a halfvec column the survivors are rescored
+                    against in SQL
+            rescore_multiplier: How many hamming candidates per result the binary and int8 modes rescore, and how
+                many candidates each funnel stage keeps per result of the next stage
+            funnel_dims: Ascending MRL prefix sizes for funnel search, e.g. [64, 256, 1024]. The full embedding of
+                the last size is stored once, an ANN index on the first prefix builds the shortlist and every
+                later prefix rescores it. Overrides dimensions, float32/halfvec precision only.
+            index_type: ANN index used for cosine search, hnsw suits tables that grow row by row
+            ivfflat_lists: Number of ivfflat lists, set at index build time
+            ivfflat_probes: Lists scanned per ivfflat query, higher is more accurate and slower
+            hnsw_m: Max connections per hnsw graph node, set at index build time
+            hnsw_ef_construction: Candidate list size while building the hnsw graph
+            hnsw_ef_search: Candidate list size per hnsw query, must be >= top_k to return top_k rows
+            use_embedding_cache: Reuse embeddings of previously seen texts from the shared content hash cache
+            user_id: Scope of a shared table, queries only see this user's rows and inserts are tagged with it
+            chat_id: Chat inserted rows are tagged with
         """
-        # Initialize the embedding model with MRL
-        self.model = SentenceTransformer(model_name, truncate_dim=dimensions)
-        self.use_binary = use_binary
+        # The model is shared process wide, MRL truncation to dimensions is applied per call
+        self.model_name = model_name
+        self.model = get_embedding_model(model_name)
+        self.precision = "binary" if use_binary else precision
+        self.use_binary = self.precision == "binary"
+        self.rescore_multiplier = rescore_multiplier
+        self.funnel_dims = funnel_dims
+        if funnel_dims is not None:
+            if list(funnel_dims) != sorted(set(funnel_dims)):
+                raise ValueError(f"funnel_dims must be strictly ascending, got {funnel_dims}")
+            if self.precision not in ("float32", "halfvec"):
+                raise ValueError(f"funnel search needs float32 or halfvec precision, got {self.precision}")
+            dimensions = funnel_dims[-1]
         self.dimensions = dimensions
+        self.index_type = index_type
+        self.ivfflat_lists = ivfflat_lists
+        self.ivfflat_probes = ivfflat_probes
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef_search = hnsw_ef_search
+
+        self.user_id = user_id
+        self.chat_id = chat_id
 
         # Setup database connection
         self.table_name = table_name
-        self.conn_string = f"postgresql://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['dbname']}"
-        
-        # Initialize database
-        self._init_db()
-
-    def _init_db(self):
-        """Initialize the database schema with pgvector extension."""
-        with psycopg2.connect(self.conn_string) as conn:
-            with conn.cursor() as cur:
-                # Enable pgvector extension
-                cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
-                
-                # Create table for storing embeddings and metadata
-                cur.execute(f"""
-                    CREATE TABLE IF NOT EXISTS {self.table_name} (
-                        id SERIAL PRIMARY KEY,
-                        content TEXT,
-                        embedding vector(%s),
-                        metadata JSONB,
-                        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                        content_tsv tsvector
-                    );
-                """, (self.dimensions,))
-                
-               
-                # Create GIN index on content_tsv for efficient BM25 search
-                cur.execute(f"""
-                    CREATE INDEX IF NOT EXISTS {self.table_name}_content_tsv_idx
-                    ON {self.table_name} 
-                    USING GIN (content_tsv);
-                """)
+        self.db_config = db_config
+        self.embedding_cache = get_embedding_cache(db_config) if use_embedding_cache else None
 
-                # Create an index for faster similarity search
-                cur.execute(f"""
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[AsyncConnection]:
+        """Pooled connection for one transaction, ensures the schema first."""
+        await self._ensure_schema()
+        async with db.connection(self.db_config) as conn:
+            yield conn
+
+    async def _ensure_schema(self):
+        """Initialize the database schema with pgvector extension, once per table and process."""
+        if self.table_name in _initialized_tables:
+            return
+        async with _init_locks.setdefault(self.table_name, asyncio.Lock()):
+            if self.table_name in _initialized_tables:
+                return
+            async with db.connection(self.db_config) as conn:
+                await self._create_schema(conn)
+            _initialized_tables.add(self.table_name)
+
+    async def _create_schema(self, conn: AsyncConnection):
+        # DDL can't take bind parameters and isn't worth preparing, values are inlined and prepare is off
+        async with conn.cursor() as cur:
+            # Enable pgvector extension
+            await cur.execute("CREATE EXTENSION IF NOT EXISTS vector;", prepare=False)
+            await cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;", prepare=False)
+            await cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector';", prepare=False)
+            extversion = (await cur.fetchone())[0]
+            _pgvector_versions[db.make_dsn(self.db_config)] = tuple(int(part) for part in extversion.split(".") if part.isdigit())
+            
+            # Create table for storing embeddings and metadata
+            embedding_columns = ",\n".join(f"{name} {column_type}" for name, column_type in self._embedding_columns())
+            await cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    id SERIAL PRIMARY KEY,
+                    user_id TEXT,
+                    chat_id TEXT,
+                    content TEXT,
+                    {embedding_columns},
+                    metadata JSONB,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    content_tsv tsvector
+                );
+            """, prepare=False)
+            await cur.execute(f"ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS user_id TEXT;", prepare=False)
+            await cur.execute(f"ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS chat_id TEXT;", prepare=False)
+            # int8 tables from before the halfvec rescoring column existed
+            for name, column_type in self._embedding_columns():
+                await cur.execute(f"ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS {name} {column_type};", prepare=False)
+
+            # btree for the user_id/chat_id scope filter of shared tables
+            await cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self.table_name}_scope_idx
+                ON {self.table_name} (user_id, chat_id);
+            """, prepare=False)
+           
+            # Create GIN index on content_tsv for efficient BM25 search
+            await cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self.table_name}_content_tsv_idx
+                ON {self.table_name} 
+                USING GIN (content_tsv);
+            """, prepare=False)
+
+            # Create an index for faster similarity search, only one ANN index is kept per table
+            index_column, index_ops = self._index_column()
+            if self.index_type == "hnsw":
+                await cur.execute(f"DROP INDEX IF EXISTS {self.table_name}_idx;", prepare=False)
+                await cur.execute(f"""
+                    CREATE INDEX IF NOT EXISTS {self.table_name}_hnsw_idx
+                    ON {self.table_name}
+                    USING hnsw ({index_column} {index_ops})
+                    WITH (m = {int(self.hnsw_m)}, ef_construction = {int(self.hnsw_ef_construction)});
+                """, prepare=False)
+            else:
+                await cur.execute(f"DROP INDEX IF EXISTS {self.table_name}_hnsw_idx;", prepare=False)
+                await cur.execute(f"""
                     CREATE INDEX IF NOT EXISTS {self.table_name}_idx 
                     ON {self.table_name} 
-                    USING ivfflat (embedding vector_cosine_ops)
-                    WITH (lists = 100);
-                """)
-                
-                conn.commit()
+                    USING ivfflat ({index_column} {index_ops})
+                    WITH (lists = {int(self.ivfflat_lists)});
+                """, prepare=False)
+
+    def _embedding_columns(self) -> List[Tuple[str, str]]:
+        """(name, type) of the embedding columns for this precision."""
+        if self.precision == "float32":
+            return [("embedding", f"vector({int(self.dimensions)})")]
+        if self.precision == "halfvec":
+            return [("embedding", f"halfvec({int(self.dimensions)})")]
+        if self.precision == "binary":
+            return [("embedding_bits", f"bit({int(self.dimensions)})"), ("embedding", f"halfvec({int(self.dimensions)})")]
+        return [("embedding_bits", f"bit({int(self.dimensions)})"), ("embedding_int8", "bytea"), ("embedding", f"halfvec({int(self.dimensions)})")]
+
+    def _index_column(self) -> Tuple[str, str]:
+        """Column and operator class the ANN index is built on, quantized precisions search hamming distance."""
+        if self.funnel_dims is not None:
+            vector_type = "vector" if self.precision == "float32" else "halfvec"
+            return f"({self._prefix_expression(self.funnel_dims[0])})", f"{vector_type}_cosine_ops"
+        if self.precision == "float32":
+            return "embedding", "vector_cosine_ops"
+        if self.precision == "halfvec":
+            return "embedding", "halfvec_cosine_ops"
+        return "embedding_bits", "bit_hamming_ops"
+
+    async def _encode_text(self, text: str, embed_type: str="document") -> np.ndarray:
+        """Encode text using the embedding model with MRL, quantization for storage happens at insert time."""
+        return (await self._encode_texts([text], embed_type))[0]
+
+    async def _encode_texts(self, texts: List[str], embed_type: str="document") -> np.ndarray:
+        """Encode a list of texts. Cached embeddings are reused and all misses are submitted to the batcher at once."""
+        cached = await self._cached_embeddings(texts, embed_type)
+        embeddings, encoded_texts, encoded = await self._encode_uncached(texts, cached, embed_type)
+        await self._cache_embeddings(encoded_texts, encoded, embed_type)
+        return embeddings
+
+    async def _cached_embeddings(self, texts: List[str], embed_type: str = "document", conn: Optional[AsyncConnection] = None) -> List[Optional[np.ndarray]]:
+        """Cache lookup for texts, None per miss. conn is read through instead of a pooled connection when given."""
+        if self.embedding_cache is None:
+            return [None] * len(texts)
+        return await self.embedding_cache.get_many(self.model_name, self.dimensions, "float32", texts, embed_type, conn=conn)
+
+    async def _encode_uncached(self, texts: List[str], cached: List[Optional[np.ndarray]], embed_type: str = "document") -> Tuple[np.ndarray, List[str], np.ndarray]:
+        """Encodes the cache misses without touching the database.
+
+        Returns:
+            (embeddings of all texts, texts that were encoded, their new embeddings)
+        """
+        embeddings = list(cached)
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        missing_texts = [texts[idx] for idx in missing]
+        encoded = np.empty((0, self.dimensions))
+        if missing:
+            encoded = await get_embedding_batcher().aencode(missing_texts, model_name=self.model_name, dimensions=self.dimensions, embed_type=embed_type)
+            for idx, embedding in zip(missing, encoded):
+                embeddings[idx] = embedding
+        return (np.stack(embeddings) if embeddings else np.empty((0, self.dimensions))), missing_texts, encoded
+
+    async def _cache_embeddings(self, texts: List[str], embeddings: np.ndarray, embed_type: str = "document", conn: Optional[AsyncConnection] = None):
+        if self.embedding_cache is not None and len(texts) > 0:
+            await self.embedding_cache.put_many(self.model_name, self.dimensions, "float32", texts, embeddings, embed_type, conn=conn)
+
+    @staticmethod
+    def _to_vector_literal(embedding: np.ndarray) -> str:
+        """pgvector text format, '[0.1,0.2,...]'."""
+        return "[" + ",".join(str(float(value)) for value in embedding) + "]"
+
+    @staticmethod
+    def _to_bit_literal(embedding: np.ndarray) -> str:
+        """Sign bit binary quantization in pgvector bit text format, '1001...'."""
+        return "".join("1" if value > 0 else "0" for value in embedding)
+
+    @staticmethod
+    def _to_int8(embedding: np.ndarray) -> bytes:
+        """Symmetric int8 scalar quantization, the per vector scale is dropped since cosine ignores it."""
+        scale = 127 / max(float(np.max(np.abs(embedding))), 1e-12)
+        return np.clip(np.round(np.asarray(embedding) * scale), -127, 127).astype(np.int8).tobytes()
+
+    def _embedding_values(self, embedding: np.ndarray) -> tuple:
+        """Values for the _embedding_columns() of one row, in column order."""
+        if self.precision in ("float32", "halfvec"):
+            return (self._to_vector_literal(embedding),)
+        if self.precision == "binary":
+            return (self._to_bit_literal(embedding), self._to_vector_literal(embedding))
+        return (self._to_bit_literal(embedding), self._to_int8(embedding), self._to_vector_literal(embedding))
+
+    def _embedding_placeholders(self) -> str:
+        return ", ".join(
+            "%s" if column_type == "bytea" else f"%s::{column_type}"
+            for _, column_type in self._embedding_columns()
+        )
+
+    def _supports_iterative_scan(self) -> bool:
+        return _pgvector_versions.get(db.make_dsn(self.db_config), ()) >= ITERATIVE_SCAN_VERSION
+
+    async def _set_search_params(self, cur, candidates: int = 0):
+        """Per transaction ANN accuracy knobs, SET LOCAL so pooled connections aren't affected.
 
-    def _encode_text(self, text: str, embed_type: str="document") -> np.ndarray:
-        """Encode text using the embedding model with MRL and optional BQL."""
+        A scoped query filters the index scan's rows by user_id afterwards, so on a shared table a single pass
+        over ef_search (or probes) neighbours can leave far fewer than candidates rows. On pgvector >= 0.8
+        iterative index scans keep scanning until enough rows pass the filter, relaxed_order can return them
+        slightly out of order and every query re-sorts by similarity on top of the index scan. Older servers
+        don't know the setting, there the single pass is widened by SCOPED_OVERFETCH instead.
 
-        # Add query prompt for retrieval tasks
-        if embed_type == "query":
-            text = f"Represent this sentence for searching relevant passages: {text}"
-            embedding = self.model.encode(text, prompt_name="query", show_progress_bar=False)
+        Args:
+            candidates: Rows the index scan has to produce, hnsw can't return more than ef_search rows per pass
+        """
+        iterative_scan = self.user_id is not None and self._supports_iterative_scan()
+        overfetch = SCOPED_OVERFETCH if self.user_id is not None and not iterative_scan else 1
+        if self.index_type == "hnsw":
+            ef_search = min(max(self.hnsw_ef_search, candidates) * overfetch, MAX_HNSW_EF_SEARCH)
+            await cur.execute(f"SET LOCAL hnsw.ef_search = {int(ef_search)};", prepare=False)
         else:
-            embedding = self.model.encode(text, show_progress_bar=False)
-        
-        # Apply binary quantization if enabled
-        if self.use_binary:
-            embedding = quantize_embeddings([embedding], precision="ubinary")[0]
-            
-        return embedding
+            probes = min(self.ivfflat_probes * overfetch, self.ivfflat_lists)
+            await cur.execute(f"SET LOCAL ivfflat.probes = {int(probes)};", prepare=False)
+        if iterative_scan:
+            await cur.execute(f"SET LOCAL {self.index_type}.iterative_scan = relaxed_order;", prepare=False)
 
-    def insert(self, content: str, metadata: Dict[str, Any] = None) -> int:
+    def _scope_filter(self) -> Tuple[str, tuple]:
+        """WHERE clause restricting a shared table to this instance's user, empty when unscoped."""
+        if self.user_id is None:
+            return "", ()
+        return "user_id = %s", (self.user_id,)
+
+    async def count(self) -> int:
+        """Number of rows visible in this instance's scope."""
+        scope_sql, scope_params = self._scope_filter()
+        async with self._connection() as conn:
+            cur = await conn.execute(f"SELECT count(*) FROM {self.table_name} {'WHERE ' + scope_sql if scope_sql else ''};", scope_params)
+            return (await cur.fetchone())[0]
+
+    async def insert(self, content: str, metadata: Dict[str, Any] = None) -> int:
         """Insert content and its embedding into the database.
         
         Args:
@@ -101,120 +327,582 @@ class VectorSearch:
         Returns:
             id: The ID of the inserted record
         """
-        embedding = self._encode_text(content)
-        
-        with psycopg2.connect(self.conn_string) as conn:
-            with conn.cursor() as cur:
-                query_sql = f"""
-                    INSERT INTO {self.table_name} (content, embedding, metadata, content_tsv)
-                    VALUES (%s, %s, %s, to_tsvector(%s))
-                    RETURNING id;
-                """
-                cur.execute(query_sql, (content, embedding.tolist(), Json(metadata) if metadata else Json({}), content))
-                
-                record_id = cur.fetchone()[0]
-                conn.commit()
-                
-        return record_id
+        return (await self.insert_many([(content, metadata)]))[0]
+
+    async def insert_many(self, items: List[Tuple[str, Dict[str, Any]]], chat_ids: Optional[List[str]] = None) -> List[int]:
+        """Insert a few (content, metadata) items in one transaction, bulk_insert() is faster for large batches.
+
+        Args:
+            items: List of (content, metadata) tuples
+            chat_ids: Per item chat_id, defaults to this instance's chat_id
+
+        Returns:
+            List of inserted record IDs
+        """
+        embeddings = await self._encode_texts([content for content, _ in items])
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                return await self._insert_rows(cur, items, embeddings, chat_ids)
 
-    def query_bm25(self, query_text: str, top_k: int = 5) -> List[Dict[str, Any]]:
+    async def query_bm25(self, query_text: str, top_k: int = 5) -> List[Dict[str, Any]]:
         """Search for documents using BM25 relevance scoring on full-text matches."""
-        with psycopg2.connect(self.conn_string) as conn:
-            with conn.cursor() as cur:
-                cur.execute(f"""
-                    SELECT id, content, metadata, ts_rank(content_tsv, plainto_tsquery(%s)) AS rank
-                    FROM {self.table_name}
-                    WHERE content_tsv @@ plainto_tsquery(%s)
-                    ORDER BY rank DESC
-                    LIMIT %s;
-                """, (query_text, query_text, top_k))
-                
-                results = []
-                for id_, content, metadata, rank in cur.fetchall():
-                    results.append({
-                        "id": id_,
-                        "content": content,
-                        "metadata": metadata,
-                        "rank": float(rank)
-                    })
+        scope_sql, scope_params = self._scope_filter()
+        async with self._connection() as conn:
+            cur = await conn.execute(f"""
+                SELECT id, content, metadata, ts_rank(content_tsv, plainto_tsquery(%s)) AS rank
+                FROM {self.table_name}
+                WHERE content_tsv @@ plainto_tsquery(%s) {'AND ' + scope_sql if scope_sql else ''}
+                ORDER BY rank DESC
+                LIMIT %s;
+            """, (query_text, query_text, *scope_params, top_k))
+            rows = await cur.fetchall()
                 
+        results = []
+        for id_, content, metadata, rank in rows:
+            results.append({
+                "id": id_,
+                "content": content,
+                "metadata": metadata,
+                "rank": float(rank)
+            })
         return results
 
-    def query(self, query_text: str, top_k: int = 5, min_p: float = 0.4) -> List[Dict[str, Any]]:
+    async def query(self, query_text: str, top_k: int = 5, min_p: float = 0.4) -> List[Dict[str, Any]]:
         """Find the top_k most similar items to the query text.
+
+        The nearest neighbour search runs in postgres on the ANN index (ORDER BY embedding <=> query LIMIT top_k),
+        so only top_k rows are transferred no matter how large the table is.
         
         Args:
             query_text: The text to find similar items for
             top_k: Number of results to return
+            min_p: Minimum cosine similarity a result needs
             
         Returns:
             List of dicts containing id, content, metadata, and similarity score
         """
         print(f"querying {self.table_name} for query: {query_text}")
-        query_embedding = self._encode_text(query_text, embed_type="query")
-        
-        with psycopg2.connect(self.conn_string) as conn:
-            with conn.cursor() as cur:
-                cur.execute(f"""
-                    SELECT id, content, embedding, metadata 
-                    FROM {self.table_name};
-                """)
-                tool_rows = cur.fetchall()
-
-                top_k_tools = torch.topk(torch.tensor([]), 0)
-                if len(tool_rows) > 0:
-                    query_to_tools_sim = torch.cosine_similarity(
-                        torch.Tensor(query_embedding),
-                        torch.Tensor([json.loads(i[2]) for i in tool_rows])
-                    )
-                    top_k_tools = query_to_tools_sim.topk(min(top_k, query_to_tools_sim.shape[0]))
-                
-                results = []
-                for i in range(len(top_k_tools.indices)):
-                    if float(top_k_tools.values[i]) > min_p:
-                        tool_idx = top_k_tools.indices[i]
-                        results.append({
-                            "id": tool_rows[tool_idx][0],
-                            "content": tool_rows[tool_idx][1],
-                            "metadata": tool_rows[tool_idx][3],
-                            "similarity": float(top_k_tools.values[i])
-                        })
+        return await self._query_embedding(await self._encode_text(query_text, embed_type="query"), top_k, min_p)
+
+    def _prefix_expression(self, dims: int) -> str:
+        """SQL for the first dims values of the stored embedding, matches the funnel index expression."""
+        if dims == self.dimensions:
+            return "embedding"
+        vector_type = "vector" if self.precision == "float32" else "halfvec"
+        return f"subvector(embedding, 1, {int(dims)})::{vector_type}({int(dims)})"
+
+    def _stage_limits(self, limit: int, stages: int) -> List[int]:
+        """Candidates kept by each of stages search stages so the last one keeps limit."""
+        return [limit * self.rescore_multiplier ** (stages - 1 - stage) for stage in range(stages)]
+
+    def _candidate_count(self, limit: int) -> int:
+        """Rows the ANN index scan has to produce to answer a query for limit results."""
+        if self.funnel_dims is not None:
+            return self._stage_limits(limit, len(self.funnel_dims))[0]
+        if self.precision == "binary":
+            return limit * self.rescore_multiplier
+        if self.precision == "int8":
+            return limit * self.rescore_multiplier ** 2
+        return limit
+
+    def _funnel_sql(self, query_embedding: np.ndarray, where: str, scope_params: tuple, limit: int, stages: List[int]) -> Tuple[str, tuple]:
+        """
+        Nested funnel query: the first stage takes a shortlist from the prefix index, each later stage re-ranks
+        the previous one at its own prefix size, and the result is (id, similarity) at the last stage's size.
+        """
+        vector_type = "vector" if self.precision == "float32" else "halfvec"
+
+        def query(dims: int) -> str:
+            return self._to_vector_literal(query_embedding[:dims])
+
+        limits = self._stage_limits(limit, len(stages))
+        sql = f"""
+            SELECT id, embedding
+            FROM {self.table_name}
+            {where}
+            ORDER BY {self._prefix_expression(stages[0])} <=> %s::{vector_type}({int(stages[0])})
+            LIMIT %s
+        """
+        params = (*scope_params, query(stages[0]), limits[0])
+        for dims, stage_limit in zip(stages[1:], limits[1:]):
+            sql = f"""
+                SELECT id, embedding
+                FROM ({sql}) candidates_{int(dims)}
+                ORDER BY {self._prefix_expression(dims)} <=> %s::{vector_type}({int(dims)})
+                LIMIT %s
+            """
+            params = (*params, query(dims), stage_limit)
+
+        return f"""
+            SELECT id, 1 - ({self._prefix_expression(stages[-1])} <=> %s::{vector_type}({int(stages[-1])})) AS similarity
+            FROM ({sql}) funnel
+            ORDER BY similarity DESC
+        """, (query(stages[-1]), *params)
+
+    def _nearest_sql(self, query_embedding: np.ndarray, scope_sql: str, scope_params: tuple, limit: int) -> Tuple[str, tuple]:
+        """SQL selecting the limit nearest rows as (id, similarity) for this precision, and its params.
+
+        Funnel mode runs _funnel_sql. Otherwise float32/halfvec search the cosine index directly. binary takes rescore_multiplier * limit hamming
+        candidates from the bit index and rescores them with exact cosine against the halfvec column. int8 does the
+        same here, query() adds its int8 stage in between (see _query_int8).
+        """
+        where = f"WHERE {scope_sql}" if scope_sql else ""
+        if self.funnel_dims is not None:
+            return self._funnel_sql(query_embedding, where, scope_params, limit, self.funnel_dims)
+        if self.precision in ("float32", "halfvec"):
+            vector_type = "vector" if self.precision == "float32" else "halfvec"
+            query = self._to_vector_literal(query_embedding)
+            return f"""
+                SELECT id, 1 - (embedding <=> %s::{vector_type}) AS similarity
+                FROM {self.table_name}
+                {where}
+                ORDER BY embedding <=> %s::{vector_type}
+                LIMIT %s
+            """, (query, *scope_params, query, limit)
+
+        bits = self._to_bit_literal(query_embedding)
+        bit_type = f"bit({int(self.dimensions)})"
+        if self.precision in ("binary", "int8"):
+            return f"""
+                SELECT id, 1 - (embedding <=> %s::halfvec) AS similarity
+                FROM (
+                    SELECT id, embedding
+                    FROM {self.table_name}
+                    {where}
+                    ORDER BY embedding_bits <~> %s::{bit_type}
+                    LIMIT %s
+                ) candidates
+                ORDER BY similarity DESC
+                LIMIT %s
+            """, (self._to_vector_literal(query_embedding), *scope_params, bits, limit * self.rescore_multiplier, limit)
+
+    async def _query_int8(self, cur, query_embedding: np.ndarray, scope_sql: str, scope_params: tuple, top_k: int, min_p: float) -> List[tuple]:
+        """
+        Hamming candidates from the bit index, narrowed to rescore_multiplier * top_k with cosine against their
+        int8 vectors in numpy, and those rescored with exact cosine against the halfvec column.
+        """
+        shortlist_size = top_k * self.rescore_multiplier
+        await cur.execute(f"""
+            SELECT id, embedding_int8
+            FROM {self.table_name}
+            {'WHERE ' + scope_sql if scope_sql else ''}
+            ORDER BY embedding_bits <~> %s::bit({int(self.dimensions)})
+            LIMIT %s;
+        """, (*scope_params, self._to_bit_literal(query_embedding), shortlist_size * self.rescore_multiplier))
+        rows = await cur.fetchall()
+        if len(rows) == 0:
+            return []
+
+        candidates = np.frombuffer(b"".join(bytes(row[1]) for row in rows), dtype=np.int8).reshape(len(rows), -1).astype(np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        similarities = candidates @ query / (np.linalg.norm(candidates, axis=1) * np.linalg.norm(query) + 1e-12)
+        shortlist = [rows[idx][0] for idx in np.argsort(-similarities)[:shortlist_size]]
+
+        await cur.execute(f"""
+            SELECT id, content, metadata, similarity
+            FROM (
+                SELECT id, content, metadata, 1 - (embedding <=> %s::halfvec) AS similarity
+                FROM {self.table_name}
+                WHERE id = ANY(%s)
+            ) shortlist
+            WHERE similarity > %s
+            ORDER BY similarity DESC
+            LIMIT %s;
+        """, (self._to_vector_literal(query_embedding), shortlist, min_p, top_k))
+        return await cur.fetchall()
+
+    async def _query_embedding(self, query_embedding: np.ndarray, top_k: int, min_p: float) -> List[Dict[str, Any]]:
+        scope_sql, scope_params = self._scope_filter()
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                await self._set_search_params(cur, self._candidate_count(top_k))
+                if self.precision == "int8":
+                    rows = await self._query_int8(cur, query_embedding, scope_sql, scope_params, top_k, min_p)
+                else:
+                    nearest_sql, nearest_params = self._nearest_sql(query_embedding, scope_sql, scope_params, top_k)
+                    # the threshold is applied outside the ordered LIMIT so the planner keeps using the index
+                    await cur.execute(f"""
+                        SELECT d.id, d.content, d.metadata, nearest.similarity
+                        FROM ({nearest_sql}) nearest
+                        JOIN {self.table_name} d ON d.id = nearest.id
+                        WHERE nearest.similarity > %s
+                        ORDER BY nearest.similarity DESC;
+                    """, (*nearest_params, min_p))
+                    rows = await cur.fetchall()
                 
+        results = []
+        for id_, content, metadata, similarity in rows:
+            results.append({
+                "id": id_,
+                "content": content,
+                "metadata": metadata,
+                "similarity": float(similarity)
+            })
+        return results
+
+    async def hybrid_query(
+        self,
+        query_text: str,
+        top_k: int = 5,
+        vector_candidates: int = 40,
+        text_candidates: int = 40,
+        vector_weight: float = 1.0,
+        text_weight: float = 1.0,
+        rrf_k: int = 60
+    ) -> List[Dict[str, Any]]:
+        """Find the top_k items by fusing vector and BM25 results with reciprocal rank fusion.
+
+        Both candidate lists are generated and fused in one SQL round trip. An item scores
+        weight / (rrf_k + rank) for each list it appears in, so exact phrase and tool name matches that
+        embeddings rank poorly still surface through the full text list.
+
+        Args:
+            query_text: The text to search for
+            top_k: Number of results to return
+            vector_candidates: How many nearest neighbours the vector stage contributes
+            text_candidates: How many full text matches the BM25 stage contributes
+            vector_weight: RRF weight of the vector ranking
+            text_weight: RRF weight of the BM25 ranking
+            rrf_k: RRF rank offset, higher values flatten the difference between top and lower ranks
+
+        Returns:
+            List of dicts containing id, content, metadata, fused score, similarity and text rank (None when
+            the item wasn't a candidate of that stage)
+        """
+        logger.debug("Hybrid_query {table} {top_k}", table=self.table_name, top_k=top_k)
+        query_embedding = await self._encode_text(query_text, embed_type="query")
+        return await self._hybrid_query_embedding(query_text, query_embedding, top_k, vector_candidates, text_candidates, vector_weight, text_weight, rrf_k)
+
+    async def _hybrid_query_embedding(
+        self,
+        query_text: str,
+        query_embedding: np.ndarray,
+        top_k: int,
+        vector_candidates: int,
+        text_candidates: int,
+        vector_weight: float,
+        text_weight: float,
+        rrf_k: int
+    ) -> List[Dict[str, Any]]:
+        scope_sql, scope_params = self._scope_filter()
+        nearest_sql, nearest_params = self._nearest_sql(query_embedding, scope_sql, scope_params, vector_candidates)
+        async with self._connection() as conn:
+            async with conn.cursor() as cur:
+                await self._set_search_params(cur, self._candidate_count(vector_candidates))
+                await cur.execute(f"""
+                    WITH vector_candidates AS (
+                        SELECT id, similarity, row_number() OVER (ORDER BY similarity DESC) AS rank
+                        FROM ({nearest_sql}) nearest
+                    ),
+                    text_candidates AS (
+                        SELECT id, text_rank, row_number() OVER (ORDER BY text_rank DESC) AS rank
+                        FROM (
+                            SELECT id, ts_rank(content_tsv, text_query) AS text_rank
+                            FROM {self.table_name}, plainto_tsquery(%s) text_query
+                            WHERE content_tsv @@ text_query {'AND ' + scope_sql if scope_sql else ''}
+                            ORDER BY text_rank DESC
+                            LIMIT %s
+                        ) matches
+                    ),
+                    fused AS (
+                        SELECT
+                            COALESCE(v.id, t.id) AS id,
+                            COALESCE(%s::float8 / (%s + v.rank), 0) + COALESCE(%s::float8 / (%s + t.rank), 0) AS score,
+                            v.similarity,
+                            t.text_rank
+                        FROM vector_candidates v
+                        FULL OUTER JOIN text_candidates t ON v.id = t.id
+                    )
+                    SELECT f.id, d.content, d.metadata, f.score, f.similarity, f.text_rank
+                    FROM fused f
+                    JOIN {self.table_name} d ON d.id = f.id
+                    ORDER BY f.score DESC
+                    LIMIT %s;
+                """, (
+                    *nearest_params,
+                    query_text, *scope_params, text_candidates,
+                    vector_weight, rrf_k, text_weight, rrf_k,
+                    top_k
+                ))
+                rows = await cur.fetchall()
+
+        results = []
+        for id_, content, metadata, score, similarity, text_rank in rows:
+            results.append({
+                "id": id_,
+                "content": content,
+                "metadata": metadata,
+                "score": float(score),
+                "similarity": float(similarity) if similarity is not None else None,
+                "text_rank": float(text_rank) if text_rank is not None else None
+            })
         return results
 
-    def bulk_insert(self, items: List[Tuple[str, Dict[str, Any]]]) -> List[int]:
+    async def bulk_insert(self, items: List[Tuple[str, Dict[str, Any]]], chat_ids: Optional[List[str]] = None, chunk_size: int = 512) -> List[int]:
         """Insert multiple items efficiently.
+
+        Items are processed in chunks: while one chunk is serialized and sent with binary COPY into a staging
+        table, the next one is being encoded, so at most two chunks of embeddings are held in memory. The rows
+        are moved into the table with their tsvectors in one set-based INSERT ... SELECT at the end.
         
         Args:
             items: List of (content, metadata) tuples
+            chat_ids: Per item chat_id, defaults to this instance's chat_id
+            chunk_size: Items encoded and copied per chunk
             
         Returns:
             List of inserted record IDs
         """
-        # Generate all embeddings in parallel
-        contents = [item[0] for item in items]
-        embeddings = [self._encode_text(content).tolist() for content in contents]
+        if len(items) == 0:
+            return []
+        chat_ids = chat_ids if chat_ids is not None else [self.chat_id] * len(items)
+        chunks = [range(start, min(start + chunk_size, len(items))) for start in range(0, len(items), chunk_size)]
+        embedding_columns = ", ".join(name for name, _ in self._embedding_columns())
+        started_at = time.perf_counter()
+
+        pending = None
+        try:
+            async with self._connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(f"""
+                        CREATE TEMP TABLE {self.table_name}_staging (
+                            seq BIGINT,
+                            user_id TEXT,
+                            chat_id TEXT,
+                            content TEXT,
+                            {", ".join(f"{name} {column_type}" for name, column_type in self._embedding_columns())},
+                            metadata JSONB
+                        ) ON COMMIT DROP;
+                    """, prepare=False)
+
+                    async def start_encoding(chunk: range) -> asyncio.Task:
+                        # the cache is read and written on this transaction's connection, in between the COPYs, so a
+                        # bulk insert never waits on the pool for a second connection. Only the model runs concurrently
+                        texts = [items[idx][0] for idx in chunk]
+                        cached = await self._cached_embeddings(texts, conn=conn)
+                        return asyncio.create_task(self._encode_uncached(texts, cached))
+
+                    pending = await start_encoding(chunks[0])
+                    for chunk_idx, chunk in enumerate(chunks):
+                        embeddings, encoded_texts, encoded = await pending
+                        await self._cache_embeddings(encoded_texts, encoded, conn=conn)
+                        # encode the next chunk while this one is serialized and copied
+                        if chunk_idx + 1 < len(chunks):
+                            pending = await start_encoding(chunks[chunk_idx + 1])
+                        payload = self._copy_payload([
+                            (idx, chat_ids[idx], items[idx][0], embedding, items[idx][1])
+                            for idx, embedding in zip(chunk, embeddings)
+                        ])
+                        async with cur.copy(
+                            f"COPY {self.table_name}_staging (seq, user_id, chat_id, content, {embedding_columns}, metadata) FROM STDIN WITH (FORMAT binary)"
+                        ) as copy:
+                            await copy.write(payload)
+
+                    # the staging table is recreated per call, so the plan can't be reused
+                    await cur.execute(f"""
+                        INSERT INTO {self.table_name} (user_id, chat_id, content, {embedding_columns}, metadata, content_tsv)
+                        SELECT user_id, chat_id, content, {embedding_columns}, metadata, to_tsvector(content)
+                        FROM {self.table_name}_staging
+                        ORDER BY seq
+                        RETURNING id;
+                    """, prepare=False)
+                    ids = [row[0] for row in await cur.fetchall()]
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+        elapsed = time.perf_counter() - started_at
+        logger.debug("Bulk_inserted {count} {table} {seconds} {rows_per_second}", count=len(ids), table=self.table_name, seconds=round(elapsed, 2), rows_per_second=round(len(ids) / max(elapsed, 1e-9)))
+        return ids
+
+    def _binary_embedding_fields(self, embedding: np.ndarray) -> List[bytes]:
+        """COPY binary encoding of the _embedding_columns() values of one row."""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        vector_header = struct.pack(">hh", self.dimensions, 0)
+        if self.precision == "float32":
+            return [vector_header + embedding.astype(">f4").tobytes()]
+        if self.precision == "halfvec":
+            return [vector_header + embedding.astype(">f2").tobytes()]
+        bits = struct.pack(">i", self.dimensions) + np.packbits(embedding > 0).tobytes()
+        if self.precision == "binary":
+            return [bits, vector_header + embedding.astype(">f2").tobytes()]
+        return [bits, self._to_int8(embedding), vector_header + embedding.astype(">f2").tobytes()]
+
+    def _copy_payload(self, rows: List[Tuple[int, Optional[str], str, np.ndarray, Optional[Dict[str, Any]]]]) -> bytes:
+        """Postgres binary COPY payload for staging rows of (seq, chat_id, content, embedding, metadata)."""
+        def text_field(value: Optional[str]) -> bytes:
+            if value is None:
+                return struct.pack(">i", -1)
+            data = value.encode()
+            return struct.pack(">i", len(data)) + data
+
+        user_id_field = text_field(self.user_id)
+        field_count = struct.pack(">h", 5 + len(self._embedding_columns()))
+        # signature, flags, header extension length
+        parts = [b"PGCOPY\n\xff\r\n\x00", struct.pack(">ii", 0, 0)]
+        for seq, chat_id, content, embedding, metadata in rows:
+            parts.append(field_count)
+            parts.append(struct.pack(">iq", 8, seq))
+            parts.append(user_id_field)
+            parts.append(text_field(chat_id))
+            parts.append(text_field(content))
+            for field in self._binary_embedding_fields(embedding):
+                parts.append(struct.pack(">i", len(field)) + field)
+            # jsonb binary format is a version byte followed by the json text
+            metadata_json = b"\x01" + json.dumps(metadata if metadata else {}).encode()
+            parts.append(struct.pack(">i", len(metadata_json)) + metadata_json)
+        parts.append(struct.pack(">h", -1))
+        return b"".join(parts)
+
+    async def _insert_rows(self, cur, items: List[Tuple[str, Dict[str, Any]]], embeddings: np.ndarray, chat_ids: Optional[List[str]] = None) -> List[int]:
+        chat_ids = chat_ids if chat_ids is not None else [self.chat_id] * len(items)
+        # Prepare data for bulk insert
+        data = [(self.user_id, chat_id, content, *self._embedding_values(embedding), Jsonb(metadata) if metadata else Jsonb({}), content) 
+               for (content, metadata), embedding, chat_id
+               in zip(items, embeddings, chat_ids)]
         
-        with psycopg2.connect(self.conn_string) as conn:
-            with conn.cursor() as cur:
-                # Prepare data for bulk insert
-                data = [(content, embedding, Json(metadata) if metadata else Json({}), content) 
-                       for (content, metadata), embedding 
-                       in zip(items, embeddings)]
-                
-                query_sql = f"""
-                    INSERT INTO {self.table_name} (content, embedding, metadata, content_tsv)
-                    VALUES %s
-                    RETURNING id;
-                """
-                # Perform bulk insert
-                execute_values(
-                    cur,
-                    query_sql,
-                    data,
-                    template="(%s, %s, %s, to_tsvector(%s))"
-                )
-                
-                ids = [row[0] for row in cur.fetchall()]
-                conn.commit()
-        return ids
\ No newline at end of file
+        embedding_columns = ", ".join(name for name, _ in self._embedding_columns())
+        # one prepared single row INSERT, executemany sends all rows in one pipeline
+        await cur.executemany(f"""
+            INSERT INTO {self.table_name} (user_id, chat_id, content, {embedding_columns}, metadata, content_tsv)
+            VALUES (%s, %s, %s, {self._embedding_placeholders()}, %s, to_tsvector(%s))
+            RETURNING id;
+        """, data, returning=True)
+        ids = []
+        while True:
+            ids.append((await cur.fetchone())[0])
+            if not cur.nextset():
+                break
+        return ids
+
+
+async def benchmark_funnel(vector_search: VectorSearch, queries: List[str], top_k: int = 10) -> Dict[str, Dict[str, float]]:
+    """Recall@top_k and latency of every prefix of a funnel VectorSearch's stages, e.g. 64, 64>256, 64>256>1024.
+
+    Ground truth is an exact full dimension scan with index scans disabled.
+
+    Returns:
+        {stage label: {"recall": mean recall, "mean_ms": mean latency, "p95_ms": p95 latency}}
+    """
+    if vector_search.funnel_dims is None:
+        raise ValueError("benchmark_funnel needs a VectorSearch with funnel_dims")
+    stage_sets = [vector_search.funnel_dims[:stage + 1] for stage in range(len(vector_search.funnel_dims))]
+    recalls = {"exact": []}
+    latencies = {"exact": []}
+    for stages in stage_sets:
+        recalls[">".join(map(str, stages))] = []
+        latencies[">".join(map(str, stages))] = []
+
+    scope_sql, scope_params = vector_search._scope_filter()
+    where = f"WHERE {scope_sql}" if scope_sql else ""
+    async with vector_search._connection() as conn:
+        async with conn.cursor() as cur:
+            for query_text in queries:
+                query_embedding = await vector_search._encode_text(query_text, embed_type="query")
+
+                start = time.perf_counter()
+                await cur.execute("SET LOCAL enable_indexscan = off;", prepare=False)
+                await cur.execute(f"""
+                    SELECT id FROM {vector_search.table_name}
+                    {where}
+                    ORDER BY embedding <=> %s
+                    LIMIT %s;
+                """, (*scope_params, vector_search._to_vector_literal(query_embedding), top_k))
+                exact_ids = {row[0] for row in await cur.fetchall()}
+                latencies["exact"].append((time.perf_counter() - start) * 1000)
+                recalls["exact"].append(1.0)
+                await cur.execute("SET LOCAL enable_indexscan = on;", prepare=False)
+
+                for stages in stage_sets:
+                    label = ">".join(map(str, stages))
+                    funnel_sql, funnel_params = vector_search._funnel_sql(query_embedding, where, scope_params, top_k, stages)
+                    start = time.perf_counter()
+                    await vector_search._set_search_params(cur, vector_search._stage_limits(top_k, len(stages))[0])
+                    await cur.execute(f"{funnel_sql} LIMIT %s;", (*funnel_params, top_k))
+                    found_ids = {row[0] for row in await cur.fetchall()}
+                    latencies[label].append((time.perf_counter() - start) * 1000)
+                    recalls[label].append(len(found_ids & exact_ids) / max(len(exact_ids), 1))
+
+    report = {}
+    for label in recalls:
+        stage_latencies = sorted(latencies[label])
+        report[label] = {
+            "recall": float(np.mean(recalls[label])) if recalls[label] else 0.0,
+            "mean_ms": float(np.mean(stage_latencies)) if stage_latencies else 0.0,
+            "p95_ms": stage_latencies[int(0.95 * (len(stage_latencies) - 1))] if stage_latencies else 0.0,
+        }
+        print(f"{label}: recall@{top_k}={report[label]['recall']:.3f} mean={report[label]['mean_ms']:.2f}ms p95={report[label]['p95_ms']:.2f}ms")
+    return report
+
+
+async def migrate_per_chat_tables(db_config: dict[str, str], conversation_table: str = "conversation_rag", tool_table: str = "tool_rag"):
+    """One-off migration from the old conversation_rag_{chat_id}/tool_rag_{chat_id} tables to the shared ones.
+
+    Every old conversation table held the whole history of its chat's user, so rows are copied into the shared
+    conversation table tagged with that user and deduplicated on (user_id, content). Conversation tables whose
+    chat has no chat_sessions row have no user to tag their rows with and are kept for manual review. Per chat
+    tool tables are dropped since tools are indexed in memory from the tool registry (see tool_index).
+    """
+    conversation_rag = VectorSearch(db_config=db_config, dimensions=256, use_binary=False, table_name=conversation_table, index_type="hnsw")
+    async with conversation_rag._connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT tablename FROM pg_tables
+                WHERE schemaname = current_schema() AND (tablename LIKE %s OR tablename LIKE %s);
+            """, (f"{conversation_table}\\_%", f"{tool_table}\\_%"))
+            tables = [row[0] for row in await cur.fetchall()]
+
+            dropped, skipped = [], []
+            for table in tables:
+                if table.startswith(f"{conversation_table}_"):
+                    chat_id = table[len(conversation_table) + 1:].replace("_", "-")
+                    try:
+                        chat_id = str(uuid.UUID(chat_id))
+                    except ValueError:
+                        skipped.append(table)
+                        print(f"skipping {table}: {chat_id} is not a chat_id")
+                        continue
+                    await cur.execute("SELECT user_id::text FROM chat_sessions WHERE chat_id = %s::uuid;", (chat_id,))
+                    session = await cur.fetchone()
+                    if session is None:
+                        skipped.append(table)
+                        print(f"skipping {table}: no chat_sessions row for chat {chat_id}, its rows have no user")
+                        continue
+                    # user_id is TEXT here and UUID in chat_sessions
+                    await cur.execute(f"""
+                        INSERT INTO {conversation_table} (user_id, chat_id, content, embedding, metadata, created_at, content_tsv)
+                        SELECT %s, %s, t.content, t.embedding, t.metadata, t.created_at, t.content_tsv
+                        FROM {table} t
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM {conversation_table} c WHERE c.user_id = %s AND c.content = t.content
+                        );
+                    """, (session[0], chat_id, session[0]), prepare=False)
+                    print(f"migrated {cur.rowcount} rows from {table}")
+                await cur.execute(f"DROP TABLE {table};", prepare=False)
+                dropped.append(table)
+    print(f"migrated and dropped {len(dropped)} per chat tables")
+    if skipped:
+        print(f"kept {len(skipped)} per chat tables that couldn't be migrated: {', '.join(skipped)}")
+
+
+if __name__ == "__main__":
+    import sys
+    from secret_keys import POSTGRES_DB_PASSWORD
+
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: python -m llm_chatbot.rag_db migrate")
+        sys.exit(1)
+
+    async def main():
+        try:
+            await migrate_per_chat_tables({
+                "dbname": "chatbot_db",
+                "user": "chatbot_user",
+                "password": POSTGRES_DB_PASSWORD,
+                "host": "100.78.237.8",
+                "port": "5432",
+            })
+        finally:
+            await db.close_pools()
+
+    asyncio.run(main())
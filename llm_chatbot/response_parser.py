@@ -0,0 +1,239 @@
+import ast
+import json
+from dataclasses import dataclass
+from enum import Enum
+from typing import Dict, List, Optional, Union
+from loguru import logger
+
+from llm_chatbot.chatbot_data_models import AssistantResponse, ResponseType, ToolParameter
+
+
+class ParserEventType(str, Enum):
+    THOUGHT_DELTA = "thought_delta"
+    TOOL_USE_COMPLETE = "tool_use_complete"
+    INTERNAL_RESPONSE_DELTA = "internal_response_delta"
+    RESPONSE_TO_USER_DELTA = "response_to_user_delta"
+
+@dataclass
+class ParserEvent:
+    type: ParserEventType
+    content: Union[str, ToolParameter]
+
+
+class _JSONConstantsToPython(ast.NodeTransformer):
+    json_constants = {"true": True, "false": False, "null": None}
+
+    def visit_Name(self, node):
+        if node.id in self.json_constants:
+            return ast.Constant(self.json_constants[node.id])
+        return node
+
+def parse_tool_use(tool_use_text: str) -> List[dict]:
+    """
+    Parse the tool calls inside a <tool_use> block. Models emit both JSON and python
+    literal syntax (single quotes, True/False) so try JSON first then fall back to literal_eval.
+    """
+    tool_use_text = tool_use_text.strip()
+    try:
+        tool_calls = json.loads(tool_use_text)
+    except json.JSONDecodeError:
+        # map JSON constants so mixed syntax like {'on': true} still evaluates
+        tree = _JSONConstantsToPython().visit(ast.parse(tool_use_text, mode="eval"))
+        tool_calls = ast.literal_eval(tree)
+
+    if isinstance(tool_calls, dict):
+        tool_calls = [tool_calls]
+    if not isinstance(tool_calls, list):
+        raise ValueError(f"tool_use content is not a list of tool calls: {tool_use_text}")
+    return tool_calls
+
+
+class ResponseStreamParser:
+    """Single pass parser for the agent's <thought>/<tool_use>/<internal_response>/<response_to_user> protocol.
+
+    Text is fed in chunks as it arrives and each call to feed() returns the events it completed.
+    Content inside the protocol tags is taken verbatim up to the matching closing tag, so unescaped
+    '<', '>' and '&' in a response don't need sanitizing first.
+    """
+    thought_tag = "thought"
+    protected_tags = [thought_tag, ResponseType.TOOL_USE.value, ResponseType.INTERNAL_RESPONSE.value, ResponseType.USER_RESPONSE.value]
+    delta_events = {
+        thought_tag: ParserEventType.THOUGHT_DELTA,
+        ResponseType.INTERNAL_RESPONSE.value: ParserEventType.INTERNAL_RESPONSE_DELTA,
+        ResponseType.USER_RESPONSE.value: ParserEventType.RESPONSE_TO_USER_DELTA,
+    }
+    max_open_tag_len = max(len(tag) for tag in protected_tags) + 2
+
+    def __init__(self):
+        self.buffer = ""
+        self.current_tag: Optional[str] = None
+        self.response_tag: Optional[str] = None
+        self.text_parts: Dict[str, List[str]] = {tag: [] for tag in self.protected_tags}
+        self.tool_calls: List[ToolParameter] = []
+        self.tool_call_errors: List[str] = []
+
+        # <tool_use> scanner state
+        self._tool_text: List[str] = []
+        self._tool_depth = 0
+        self._tool_object_depth: Optional[int] = None
+        self._tool_object_start: Optional[int] = None
+        self._tool_string_quote: Optional[str] = None
+        self._tool_escaped = False
+
+    @classmethod
+    def parse(cls, llm_output: str) -> 'ResponseStreamParser':
+        """Parse a complete response in one go."""
+        parser = cls()
+        parser.feed(llm_output)
+        parser.close()
+        return parser
+
+    @staticmethod
+    def _partial_tag_len(text: str, tag: str) -> int:
+        """Length of the longest suffix of text that is a prefix of tag."""
+        for size in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:size]):
+                return size
+        return 0
+
+    def feed(self, chunk: str) -> List[ParserEvent]:
+        """Add a chunk of completion text and return the events it completed."""
+        self.buffer += chunk
+        events = []
+        while self.buffer:
+            if self.current_tag is None:
+                start = self.buffer.find("<")
+                if start == -1:
+                    self.buffer = ""
+                    break
+                end = self.buffer.find(">", start)
+                if end == -1:
+                    # keep a possible partial opening tag for the next chunk
+                    self.buffer = self.buffer[start:]
+                    if len(self.buffer) > self.max_open_tag_len:
+                        self.buffer = self.buffer[1:]
+                        continue
+                    break
+                tag = self.buffer[start + 1:end].strip()
+                self.buffer = self.buffer[end + 1:]
+                if tag in self.protected_tags:
+                    self.current_tag = tag
+                    if tag != self.thought_tag and self.response_tag is None:
+                        self.response_tag = tag
+                continue
+
+            close_tag = f"</{self.current_tag}>"
+            end = self.buffer.find(close_tag)
+            if end == -1:
+                # hold back a possible partial closing tag and trailing whitespace
+                keep = self._partial_tag_len(self.buffer, close_tag)
+                text = self.buffer[:len(self.buffer) - keep].rstrip()
+                self.buffer = self.buffer[len(text):]
+                events.extend(self._add_text(text))
+                break
+            events.extend(self._add_text(self.buffer[:end].rstrip()))
+            self.buffer = self.buffer[end + len(close_tag):]
+            self.current_tag = None
+        return events
+
+    def close(self) -> List[ParserEvent]:
+        """Flush whatever is left, e.g. when a completion stops inside an unclosed tag."""
+        events = []
+        if self.current_tag is not None:
+            events.extend(self._add_text(self.buffer.rstrip()))
+        self.buffer = ""
+        self.current_tag = None
+        return events
+
+    def _add_text(self, text: str) -> List[ParserEvent]:
+        if not self.text_parts[self.current_tag]:
+            text = text.lstrip()
+        if not text:
+            return []
+        self.text_parts[self.current_tag].append(text)
+
+        if self.current_tag == ResponseType.TOOL_USE.value:
+            return self._scan_tool_use(text)
+        return [ParserEvent(type=self.delta_events[self.current_tag], content=text)]
+
+    def _scan_tool_use(self, text: str) -> List[ParserEvent]:
+        """Track bracket depth and string state so each tool call object is emitted as soon as it closes."""
+        events = []
+        for char in text:
+            self._tool_text.append(char)
+            if self._tool_string_quote is not None:
+                if self._tool_escaped:
+                    self._tool_escaped = False
+                elif char == "\\":
+                    self._tool_escaped = True
+                elif char == self._tool_string_quote:
+                    self._tool_string_quote = None
+                continue
+
+            if self._tool_object_depth is None and not char.isspace():
+                # a list of tool calls puts the objects one level down, a bare object sits at the top
+                self._tool_object_depth = 1 if char == "[" else 0
+
+            if char in "\"'":
+                self._tool_string_quote = char
+            elif char in "[{":
+                if char == "{" and self._tool_depth == self._tool_object_depth:
+                    self._tool_object_start = len(self._tool_text) - 1
+                self._tool_depth += 1
+            elif char in "]}":
+                self._tool_depth -= 1
+                if char == "}" and self._tool_depth == self._tool_object_depth and self._tool_object_start is not None:
+                    tool_call = self._parse_tool_call("".join(self._tool_text[self._tool_object_start:]))
+                    self._tool_object_start = None
+                    if tool_call is not None:
+                        events.append(ParserEvent(type=ParserEventType.TOOL_USE_COMPLETE, content=tool_call))
+        return events
+
+    def _parse_tool_call(self, tool_call_text: str) -> Optional[ToolParameter]:
+        try:
+            tool_call = ToolParameter(**parse_tool_use(tool_call_text)[0])
+        except Exception as e:
+            logger.warning("Tool_call_parsing_failed {error} {tool_call_text}", error=e, tool_call_text=tool_call_text)
+            self.tool_call_errors.append(tool_call_text)
+            return None
+        self.tool_calls.append(tool_call)
+        return tool_call
+
+    def get_text(self, tag: str) -> str:
+        return "".join(self.text_parts[tag]).strip()
+
+    def to_assistant_response(self) -> AssistantResponse:
+        """
+        Build the AssistantResponse for everything parsed so far.
+
+        Raises:
+            ValueError: If no response block was found or the tool calls couldn't be parsed
+        """
+        thought = self.get_text(self.thought_tag)
+        if self.response_tag is None:
+            raise ValueError("no tool_use, internal_response or response_to_user block found")
+
+        if self.response_tag == ResponseType.TOOL_USE.value:
+            if self.tool_call_errors or not self.tool_calls:
+                # the scanner couldn't split the block cleanly, give the whole block one more try
+                return AssistantResponse.create_tool_response(thought, parse_tool_use(self.get_text(self.response_tag)))
+            return AssistantResponse.create_tool_response(thought, [tool_call.model_dump() for tool_call in self.tool_calls])
+        return AssistantResponse.create_text_response(
+            thought,
+            self.get_text(self.response_tag),
+            is_user_response=self.response_tag == ResponseType.USER_RESPONSE.value
+        )
+
+
+def parse_assistant_response(llm_output: str) -> AssistantResponse:
+    """
+    Deterministically parse a complete agent response into an AssistantResponse without a formatter LLM call.
+
+    Raises:
+        ValueError: If the text doesn't follow the protocol well enough to parse
+    """
+    return ResponseStreamParser.parse(llm_output).to_assistant_response()
+
+def extract_user_response(llm_output: str) -> str:
+    """Returns the <response_to_user> text of a complete response, or "" if there is none."""
+    return ResponseStreamParser.parse(llm_output).get_text(ResponseType.USER_RESPONSE.value)
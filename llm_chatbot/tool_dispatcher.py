@@ -0,0 +1,69 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from loguru import logger
+
+
+class ToolDispatcher:
+    def __init__(
+        self,
+        max_workers: int = 8,
+        default_tool_limit: int = 2,
+        tool_limits: Optional[Dict[str, int]] = None
+    ):
+        """Run blocking tool functions on a bounded worker pool.
+
+        Args:
+            max_workers: Number of worker threads shared by all tool calls
+            default_tool_limit: Max concurrent calls per tool group when no override is set
+            tool_limits: Per tool group (tool class name or tool name) concurrency overrides
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool_call")
+        self.default_tool_limit = default_tool_limit
+        self.tool_limits = tool_limits if tool_limits is not None else {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    @staticmethod
+    def _limit_key(tool_name: str, func: Callable) -> str:
+        """Tools that are methods of the same tool class (spotify, hue, python shell) share one limit."""
+        owner = getattr(func, "__self__", None)
+        return type(owner).__name__ if owner is not None else tool_name
+
+    def _get_semaphore(self, key: str) -> asyncio.Semaphore:
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(self.tool_limits.get(key, self.default_tool_limit))
+        return self._semaphores[key]
+
+    async def run(self, tool_name: str, func: Callable, params: Dict[str, Any]) -> Any:
+        """Run func(**params) in the worker pool without blocking the event loop.
+
+        Args:
+            tool_name: Name of the tool being called, used for the concurrency limit
+            func: The blocking tool function
+            params: Keyword arguments for the tool function
+
+        Returns:
+            Whatever the tool function returns
+        """
+        key = self._limit_key(tool_name, func)
+        async with self._get_semaphore(key):
+            logger.debug("Dispatching_tool_call {name} {limit_key}", name=tool_name, limit_key=key)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, **params))
+
+
+_dispatcher: Optional[ToolDispatcher] = None
+
+def get_tool_dispatcher() -> ToolDispatcher:
+    """Process wide dispatcher so the worker pool and per-tool limits are shared by every session."""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = ToolDispatcher(
+            tool_limits={
+                "SpotifyTool": 1,
+                "PhilipsHueTool": 1,
+                "UVPythonShellManager": 1,
+            }
+        )
+    return _dispatcher
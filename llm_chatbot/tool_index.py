@@ -0,0 +1,90 @@
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from loguru import logger
+
+from llm_chatbot.embeddings import DEFAULT_EMBEDDING_MODEL, get_embedding_batcher
+
+
+class ToolIndex:
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL, dimensions: int = 512):
+        """In-memory retrieval index over the tool descriptions.
+
+        The descriptions are embedded once into a contiguous, row normalized float32 matrix so a query is one
+        matrix-vector product. build() only re-embeds when the set of descriptions changes.
+
+        Args:
+            model_name: Embedding model to use
+            dimensions: Number of dimensions to use (MRL)
+        """
+        self.model_name = model_name
+        self.dimensions = dimensions
+        self.fingerprint: Optional[str] = None
+        # (matrix, documents) swapped as one tuple so concurrent queries always see a consistent pair
+        self._index: Tuple[np.ndarray, List[Tuple[str, Dict[str, Any]]]] = (np.empty((0, dimensions), dtype=np.float32), [])
+        self._build_lock = threading.Lock()
+
+    @staticmethod
+    def make_fingerprint(documents: List[Tuple[str, Dict[str, Any]]]) -> str:
+        return hashlib.sha256("\x00".join(sorted(content for content, _ in documents)).encode()).hexdigest()
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return np.ascontiguousarray(embeddings / np.maximum(norms, 1e-12))
+
+    def build(self, documents: List[Tuple[str, Dict[str, Any]]]) -> bool:
+        """Embed documents ((content, metadata) tuples) into the index unless they are already indexed.
+
+        Returns:
+            True if the index was rebuilt
+        """
+        fingerprint = self.make_fingerprint(documents)
+        with self._build_lock:
+            if fingerprint == self.fingerprint:
+                return False
+            embeddings = get_embedding_batcher().encode([content for content, _ in documents], model_name=self.model_name, dimensions=self.dimensions)
+            self._index = (self._normalize(embeddings).reshape(len(documents), self.dimensions), list(documents))
+            self.fingerprint = fingerprint
+        logger.info("Tool index built {count} {fingerprint}", count=len(documents), fingerprint=fingerprint)
+        return True
+
+    async def aencode_query(self, query_text: str) -> np.ndarray:
+        return await get_embedding_batcher().aencode(query_text, model_name=self.model_name, dimensions=self.dimensions, embed_type="query")
+
+    def search(self, query_embedding: np.ndarray, top_k: int = 5, min_p: float = 0.4) -> List[Dict[str, Any]]:
+        """Top_k documents by cosine similarity to query_embedding, in the VectorSearch.query result format."""
+        matrix, documents = self._index
+        if len(documents) == 0:
+            return []
+        similarities = matrix @ self._normalize(query_embedding)
+        top_k = min(top_k, len(documents))
+        top_idx = np.argpartition(-similarities, top_k - 1)[:top_k]
+        top_idx = top_idx[np.argsort(-similarities[top_idx])]
+        return [
+            {
+                "id": int(idx),
+                "content": documents[idx][0],
+                "metadata": documents[idx][1],
+                "similarity": float(similarities[idx]),
+            }
+            for idx in top_idx
+            if similarities[idx] > min_p
+        ]
+
+    async def aquery(self, query_text: str, top_k: int = 5, min_p: float = 0.4) -> List[Dict[str, Any]]:
+        return self.search(await self.aencode_query(query_text), top_k, min_p)
+
+
+_tool_index: Optional[ToolIndex] = None
+_lock = threading.Lock()
+
+def get_tool_index() -> ToolIndex:
+    """Process wide tool index, the tool registry is the same for every session."""
+    global _tool_index
+    with _lock:
+        if _tool_index is None:
+            _tool_index = ToolIndex()
+        return _tool_index
@@ -1,6 +1,5 @@
 from typing import List, Union
 from secret_keys import TOGETHER_AI_TOKEN, OPENROUTER_API_KEY
-import openai
 import xml.etree.ElementTree as ET
 import re
 import xml.sax.saxutils as saxutils
@@ -10,6 +9,7 @@ import numpy as np
 import pandas as pd
 from collections.abc import Iterable
 from numbers import Number
+from llm_chatbot.llm_transport import get_openai_client
 
 
 def get_size(obj, seen=None):
@@ -146,7 +146,7 @@ def sanitize_inner_content(llm_output):
         return f"<{tag}>{escaped_content}</{tag}>"
 
     # Escape content inside <tool_use> and <response_to_user>
-    llm_output = re.sub(r'<(tool_call_response|tool_use|response_to_user|self_response|thought)>(.*?)</\1>', escape_content, llm_output, flags=re.DOTALL)
+    llm_output = re.sub(r'<(tool_call_response|tool_use|response_to_user|internal_response|self_response|thought)>(.*?)</\1>', escape_content, llm_output, flags=re.DOTALL)
     llm_output = llm_output.replace(">\n", ">").replace("\n<", "<").strip()
     return llm_output
 
@@ -228,10 +228,7 @@ def format_function_schema(schema):
         raise ValueError(f"Error processing schema: {str(e)}")
 
 def tool_caller(tools: List, transcript: List[str]):
-    openai_client = openai.OpenAI(
-        api_key=OPENROUTER_API_KEY,
-        base_url="https://openrouter.ai/api/v1"
-    )
+    openai_client = get_openai_client("https://openrouter.ai/api/v1", OPENROUTER_API_KEY)
     
     prompt = f'''<|begin_of_text|><|start_header_id|>system<|end_header_id|>
 
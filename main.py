@@ -3,18 +3,22 @@ from pydantic import BaseModel
 from uuid import uuid4
 from typing import Dict, Any, Optional, List
 from llm_chatbot.chatbot import ChatBot
-from llm_chatbot import function_tools
+from llm_chatbot import db, function_tools, message_writer
 import os
 import numpy as np
 from PIL import Image
 import soundfile as sf
 import ffmpeg
 from prompts import SYS_PROMPT, TOOLS_PROMPT_SNIPPET, RESPONSE_FLOW_2
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg.rows import dict_row
 
 app = FastAPI()
 
+@app.on_event("shutdown")
+async def shutdown():
+    await message_writer.close_message_writers()
+    await db.close_pools()
+
 # Initialize ChatBot configurations
 tools_prompt = TOOLS_PROMPT_SNIPPET.format(TOOL_LIST=function_tools.get_tool_list_prompt(function_tools.get_tools()))
 chatbot_system_msg = SYS_PROMPT.format(TOOLS_PROMPT=tools_prompt, RESPONSE_FLOW=RESPONSE_FLOW_2)
@@ -36,6 +40,8 @@ DB_CONFIG = {
 
 class ChatSession(BaseModel):
     model: str
+    # UUID of the user the session belongs to, a new user is created when omitted
+    user_id: Optional[str] = None
     tokenizer_model: Optional[str] = ""
     system: Optional[str] = chatbot_system_msg
 
@@ -49,8 +55,9 @@ class ChatResponse(BaseModel):
 @app.post("/chat", response_model=ChatResponse)
 async def create_chat(chat_session: ChatSession):
     chat_id = str(uuid4())
-    chatbots[chat_id] = ChatBot(
+    chatbots[chat_id] = await ChatBot.create(
         model=chat_session.model,
+        user_id=chat_session.user_id or str(uuid4()),
         chat_id=chat_id,
         tokenizer_model=chat_session.tokenizer_model,
         system=chat_session.system,
@@ -62,14 +69,14 @@ async def create_chat(chat_session: ChatSession):
 async def send_message(chat_id: str, message: Message):
     if chat_id not in chatbots:
         raise HTTPException(status_code=404, detail="Chat session not found")
-    response = chatbots[chat_id](message.content)
+    response = await chatbots[chat_id](message.content)
     return ChatResponse(chat_id=chat_id, response=response)
 
 @app.get("/chat/{chat_id}/history")
 async def get_chat_history(chat_id: str):
     if chat_id not in chatbots:
         raise HTTPException(status_code=404, detail="Chat session not found")
-    return {"chat_id": chat_id, "history": chatbots[chat_id].messages}
+    return {"chat_id": chat_id, "history": chatbots[chat_id].messages.render()}
 
 @app.delete("/chat/{chat_id}")
 async def delete_chat(chat_id: str):
@@ -130,25 +137,20 @@ async def process_media(chat_id: str, file: UploadFile, media_type: str):
     os.remove(file_path)
     
     bot_message = f"User sent a {media_type}. It has been saved as {np_filename}."
-    response = chatbots[chat_id](bot_message)
+    response = await chatbots[chat_id](bot_message)
     
     return {"filename": np_filename, "response": response}
 
 @app.get("/chats")
 async def get_all_chat_sessions():
-    conn = psycopg2.connect(**DB_CONFIG)
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    try:
-        cur.execute("""
-            SELECT * FROM chat_sessions
-            ORDER BY created_at DESC
-        """)
-        chat_sessions = cur.fetchall()
-        return {"chat_sessions": chat_sessions}
-    finally:
-        cur.close()
-        conn.close()
+    async with db.connection(DB_CONFIG) as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("""
+                SELECT * FROM chat_sessions
+                ORDER BY created_at DESC
+            """)
+            chat_sessions = await cur.fetchall()
+    return {"chat_sessions": chat_sessions}
 
 @app.get("/tools")
 async def get_tools_list():